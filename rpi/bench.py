@@ -0,0 +1,409 @@
+"""Micro-benchmarks, run from the REPL with e.g. `bench.maxvalue_alloc()`."""
+import time
+
+import sensors
+from hal import SIMULATED, gc, ticks_ms, ticks_add, ticks_diff
+
+
+def _allocated(step, calls):
+    """Bytes of heap taken by `calls` calls of step(). On the device the
+    collector is held off, so mem_alloc() counts every allocation. The
+    simulator's only sees what is still live, so there each call's peak
+    above where it started is added up instead."""
+    if SIMULATED:
+        import tracemalloc
+        # mem_alloc() and tracemalloc read nothing until started
+        gc.start()
+        used = 0
+        for i in range(calls):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            step()
+            used += tracemalloc.get_traced_memory()[1] - base
+        return used
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    for i in range(calls):
+        step()
+    used = gc.mem_alloc() - before
+    gc.enable()
+    return used
+
+
+class _ListMax:
+    """MaxValue as it was: the window rebuilt as a new list of
+    (peak, time) tuples on every read."""
+    period = 2.0
+
+    def __init__(self):
+        self.history = []
+
+    def read(self, val):
+        now = time.monotonic()
+        oldest = now - self.period
+        rv = val
+        new_history = []
+        for i in self.history:
+            v, t = i
+            if t > oldest and v >= val:
+                new_history.append(i)
+                rv = max(rv, v)
+        new_history.append((val, now))
+        self.history = new_history
+        return rv
+
+
+def maxvalue_alloc(reads=100):
+    """Bytes allocated per read by the list-rebuilding window MaxValue
+    used to be and by the preallocated deque, fed falling values so
+    the window stays full. CPython puts ints and bound methods on the
+    heap too, so only on the device does the deque's figure go to
+    zero."""
+    old = _ListMax()
+    new = sensors.MaxValue()
+    values = [255 - (i & 0xFF) for i in range(reads + 10)]
+    pos = 0
+
+    def old_read():
+        nonlocal pos
+        old.read(values[pos])
+        pos += 1
+
+    def new_read():
+        nonlocal pos
+        new.push(values[pos], ticks_ms())
+        new.peak
+        pos += 1
+
+    for name, read in (('list', old_read), ('deque', new_read)):
+        # warm up, so the window is populated
+        pos = 0
+        for i in range(10):
+            read()
+        used = _allocated(read, reads)
+        print('MaxValue', name, 'read:', used // reads, 'bytes/read')
+
+
+def sampler_tick(ticks=20):
+    sampler = sensors.Sampler()
+    start = ticks_ms()
+    for i in range(ticks):
+        sampler.sample()
+    print('Sampler.sample:', (ticks_ms() - start) // ticks, 'ms/tick')
+
+
+def loop_lag(cooperative, duration=5.0):
+    """Worst-case event-loop lag (ms) seen by a probe task while the
+    sampler runs, in blocking or cooperative mode."""
+    from asyncio import run, sleep, create_task
+
+    sampler = sensors.Sampler()
+    sampler.cooperative = cooperative
+    worst = 0
+
+    async def probe():
+        nonlocal worst
+        end = ticks_add(ticks_ms(), int(duration * 1000))
+        last = ticks_ms()
+        while ticks_diff(end, last) > 0:
+            await sleep(0)
+            now = ticks_ms()
+            worst = max(worst, ticks_diff(now, last))
+            last = now
+
+    async def main():
+        task = create_task(sampler.run())
+        await probe()
+        task.cancel()
+
+    run(main())
+    print('cooperative' if cooperative else 'blocking',
+          'worst loop lag:', worst, 'ms')
+    return worst
+
+
+def detector_cpu(decisions=100):
+    """CPU time per decision of the peak and goertzel detectors, fed a
+    synthetic 250 Hz flicker so the ADC waits are left out."""
+    import math
+
+    for detector in ('peak', 'goertzel'):
+        sampler = sensors.Sampler(detector)
+        wave = [
+            int(30000 + 20000 * math.sin(2 * math.pi * 250 * i / 1000))
+            for i in range(sampler.samples)
+        ]
+        start = time.monotonic_ns()
+        for j in range(decisions):
+            for i, v in enumerate(wave):
+                sampler.cycle_complete_buf[i] = v
+                sampler.blank_buf[i] = v
+                sampler.lid_locked_buf[i] = v
+                if sampler.filters:
+                    for f in sampler.filters:
+                        f.update(v)
+            sampler._update(ticks_ms())
+        elapsed = time.monotonic_ns() - start
+        print(detector, 'detector:', elapsed // decisions // 1000,
+              'us/decision, levels', sampler.snapshot[1:])
+
+
+def scheduler_wakeups(duration=60.0):
+    """Scheduler wakeups per minute with the washer idle."""
+    from asyncio import run, wait_for, TimeoutError
+    import state
+
+    main_state = state.State()
+
+    async def main():
+        try:
+            await wait_for(main_state.update(), duration)
+        except TimeoutError:
+            pass
+
+    run(main())
+    print('scheduler:', main_state.scheduler.wakeups_per_minute,
+          'wakeups/min,', main_state.scheduler.fired, 'timers fired')
+
+
+def mqtt_framing(publishes=20, size=300):
+    """Sends and bytes per QoS 1 publish through the broker stand-in,
+    framed field by field (as umqtt used to send them) and framed into
+    one buffer. Over TLS each send is its own record, so the wire cost
+    adds TLS_RECORD bytes per send. Simulator only."""
+    from hal import socketpool, wifi
+    from hal.sim.broker import Broker
+    import umqtt
+
+    # record header, explicit nonce and tag for TLS 1.2 AES-GCM
+    TLS_RECORD = 29
+
+    class PerField(umqtt.MQTTClient):
+        def _varint(self, sz):
+            super()._varint(sz)
+            self._flush()
+
+        def _u16(self, v):
+            super()._u16(v)
+            self._flush()
+
+        def _write(self, data):
+            super()._write(data)
+            self._flush()
+
+    class Counted:
+        def __init__(self, sock):
+            self.sock = sock
+            self.sends = 0
+
+        def send(self, data):
+            self.sends += 1
+            return self.sock.send(data)
+
+        def __getattr__(self, name):
+            return getattr(self.sock, name)
+
+    broker = Broker().start()
+    msg = b'x' * size
+    for name, cls in (('per-field', PerField),
+                      ('one buffer', umqtt.MQTTClient)):
+        client = cls('bench', '127.0.0.1', port=broker.port,
+                     socket_pool=socketpool.SocketPool(wifi.radio))
+        client.set_callback(lambda topic, msg: None)
+        client.connect()
+        client.sock = Counted(client.sock)
+        broker.stats.reset()
+        for i in range(publishes):
+            client.publish('laundrymon/bench', msg, qos=1)
+        sends = client.sock.sends / publishes
+        sent = broker.stats.bytes_in / publishes
+        print(name, 'framing:', sends, 'sends/publish,', sent,
+              'bytes/publish,', sent + sends * TLS_RECORD, 'over TLS')
+        client.disconnect()
+    broker.shutdown()
+
+
+class _PerRead:
+    """The PUBLISH path of umqtt's receive as it was: each field read
+    into a new bytearray, blocking until the whole frame is there."""
+
+    def __init__(self, sock, cb):
+        self.sock = sock
+        self.cb = cb
+
+    def _recv(self, n):
+        rc = bytearray(n)
+        mv = memoryview(rc)
+        got = 0
+        while got < n:
+            got += self.sock.recv_into(mv[got:], n - got)
+        return rc
+
+    def check_msg(self):
+        self._recv(1)
+        sz, sh = 0, 0
+        while True:
+            b = self._recv(1)[0]
+            sz |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        topic_len = self._recv(2)
+        topic_len = topic_len[0] << 8 | topic_len[1]
+        topic = self._recv(topic_len)
+        self.cb(topic, self._recv(sz - topic_len - 2))
+
+
+def mqtt_receive_alloc(frames=100, chunk=7):
+    """Bytes allocated per received PUBLISH, by the per-field reads umqtt
+    used to make and by the incremental parser. Both get the frames in
+    `chunk`-byte pieces, so most span several reads. (Frames split
+    across check_msg calls are left to the simulator: under CPython the
+    EAGAIN raised to end each call would dwarf the parser.)"""
+    import umqtt
+
+    body = b'\x00\x08shadow/x{"alarm": 1}'
+    stream = (bytes((0x30, len(body))) + body) * frames
+
+    class Trickle:
+        pos = 0
+
+        def recv_into(self, buf, nbytes=0):
+            n = min(chunk, len(stream) - self.pos, nbytes or len(buf))
+            buf[:n] = memoryview(stream)[self.pos:self.pos + n]
+            self.pos += n
+            return n
+
+        def setblocking(self, flag):
+            pass
+
+    got = 0
+
+    def cb(topic, msg):
+        nonlocal got
+        got += 1
+
+    client = umqtt.MQTTClient('bench', 'localhost')
+    client.set_callback(cb)
+    client.sock = Trickle()
+    for name, receiver in (
+            ('per-field', _PerRead(Trickle(), cb)), ('incremental', client)):
+        # warm up, so the receive buffer views exist
+        for i in range(10):
+            receiver.check_msg()
+        got = 0
+        used = _allocated(receiver.check_msg, frames - 10)
+        print(name, 'MQTT receive:', got, 'frames,', used // got,
+              'bytes/frame')
+
+
+def json_publish(publishes=20):
+    """Heap allocated per full shadow publish, with the payload made by
+    json.dumps().encode() or streamed into the send buffer, and streamed
+    as IOT sends it: QoS 1 through AsyncMQTTClient, which keeps a copy
+    in flight until it is acknowledged. Counted as by _allocated(), the
+    same on the device and the simulator."""
+    import json
+    from asyncio import Lock
+    import iot
+    import state
+    import umqtt
+
+    cloud = iot.IOT(state.State())
+    msg = {'state': {'reported': cloud.reported_state(full=True)}}
+
+    class Null:
+        def send(self, data):
+            return len(data)
+
+    client = umqtt.MQTTClient('bench', 'localhost')
+    client.sock = Null()
+    pipelined = umqtt.AsyncMQTTClient('bench', 'localhost')
+    pipelined.sock = Null()
+    pipelined._lock = Lock()
+    topic = cloud.PUB_CHANNEL
+
+    def dumped():
+        client.publish(topic, json.dumps(msg).encode())
+
+    def streamed():
+        client.publish(topic, msg)
+
+    def qos1():
+        # the socket takes everything, so the publish never suspends
+        # and can be stepped without an event loop; acknowledged at
+        # once, as the reader would
+        try:
+            pipelined.publish(topic, msg, qos=1).send(None)
+        except StopIteration as stop:
+            pipelined._acked(stop.value)
+
+    for name, publish, sender in (
+            ('json.dumps', dumped, client),
+            ('streamed', streamed, client),
+            ('streamed, QoS 1', qos1, pipelined)):
+        # warm up, so the send buffer has grown to fit
+        publish()
+        start = time.monotonic_ns()
+        used = _allocated(publish, publishes)
+        elapsed = time.monotonic_ns() - start
+        print(name, 'publish:', sender.payload_size, 'byte payload,',
+              used // publishes, 'bytes/publish,',
+              elapsed // publishes // 1000, 'us')
+
+
+def mqtt_resend_recovery(reconnects=6, latency=0.03):
+    """Reconnects that succeed after a QoS 1 publish ran out of resends,
+    through the broker stand-in answering `latency` seconds late, and
+    whether the stranded publish is then acknowledged. All of them
+    should: the resends only count again once the CONNACK is in.
+    Simulator only."""
+    from asyncio import run, sleep
+    from hal import socketpool, wifi
+    from hal.sim.broker import Broker
+    import umqtt
+
+    broker = Broker().start()
+    broker.latency = latency
+
+    async def settle(client):
+        # -> whether the window emptied before the reader failed
+        end = ticks_add(ticks_ms(), 2 * client.retry_ms * client.retries)
+        while client.inflight and client.error is None \
+                and ticks_diff(end, ticks_ms()) > 0:
+            await sleep(client.poll)
+        return not client.inflight
+
+    async def main():
+        up = acked = 0
+        for i in range(reconnects):
+            client = umqtt.AsyncMQTTClient(
+                'bench', '127.0.0.1', port=broker.port,
+                socket_pool=socketpool.SocketPool(wifi.radio))
+            client.set_callback(lambda topic, msg: None)
+            client.retry_ms = 100
+            client.poll = 0.01
+            # every send of the publish goes unacknowledged
+            broker.drop_pubacks = client.retries + 1
+            await client.connect()
+            await client.publish('laundrymon/bench', b'x', qos=1)
+            while client.error is None:
+                await sleep(client.poll)
+            client.close()
+            try:
+                await client.connect()
+            except umqtt.MQTTException as error:
+                print('reconnect', i, 'failed:', error)
+                client.close()
+                continue
+            up += 1
+            acked += await settle(client)
+            client.close()
+        return up, acked
+
+    up, acked = run(main())
+    print('reconnects after exhausted resends:', up, 'of', reconnects,
+          'up,', acked, 'stranded publishes acknowledged')
+    broker.shutdown()
+    return up == acked == reconnects
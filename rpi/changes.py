@@ -0,0 +1,49 @@
+# bumped on every change anywhere, so one number orders all of them
+_version = 0
+
+
+class ChangeMixin:
+    """Change tracking by version number.
+
+    mark() stamps the changed fields with a new version. Nothing is
+    cleared on read, so any number of consumers can each remember the
+    version they last saw and ask what changed since. A `listener` set
+    on an instance is called on every mark, for consumers that cannot
+    wait to look.
+
+    `report_paths` says where a marked field sits in the object's
+    shadow report, so an update can be built from the marked fields
+    alone (see shadow.partial); report_value() gives its value there.
+    """
+    listener = None
+    report_paths = {}
+
+    def mark(self, *fields):
+        global _version
+        _version += 1
+        versions = getattr(self, '_versions', None)
+        if versions is None:
+            versions = self._versions = {}
+        for field in fields:
+            versions[field] = _version
+        self._version = _version
+        if self.listener is not None:
+            self.listener()
+
+    @property
+    def version(self):
+        return getattr(self, '_version', 0)
+
+    def changed_since(self, version):
+        return set(
+            field
+            for field, v in getattr(self, '_versions', {}).items()
+            if v > version
+        )
+
+    def report_value(self, field):
+        return getattr(self, field)
+
+
+def latest_version():
+    return _version
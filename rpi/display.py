@@ -1,14 +1,11 @@
 import collections
 import random
 import time
-import busio
-import pwmio
-import digitalio
-import displayio
-import microcontroller
-import adafruit_ili9341
-import adafruit_focaltouch
 
+from hal import (
+    busio, pwmio, digitalio, displayio, microcontroller,
+    adafruit_ili9341, adafruit_focaltouch,
+)
 from pins import Display, Touch, BACK_BUTTON, PIEZO_L, PIEZO_R
 
 # display backlight
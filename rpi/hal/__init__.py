@@ -0,0 +1,67 @@
+"""Hardware abstraction layer.
+
+On CircuitPython this re-exports the real hardware modules. Anywhere else
+(CPython on Linux) the same names come from `hal.sim`, so `State`, `IOT`
+and `UI` can be loaded, profiled and benchmarked without a Pico attached.
+Application modules import hardware from here, never directly.
+"""
+import sys
+
+SIMULATED = sys.implementation.name != 'circuitpython'
+
+if not SIMULATED:
+    import gc
+    import time
+    import board
+    import analogio
+    import bitmaptools
+    import busio
+    import digitalio
+    import displayio
+    import microcontroller
+    import pwmio
+    import socketpool
+    import terminalio
+    import vectorio
+    import wifi
+    import adafruit_focaltouch
+    import adafruit_ili9341
+    from ssl import create_default_context as ssl_create_default_context
+    from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+    from adafruit_display_shapes.roundrect import RoundRect
+    from adafruit_display_text.bitmap_label import Label
+
+    def ticks_us():
+        """Like ticks_ms(), in microseconds: wraps the same way, so
+        ticks_add() and ticks_diff() work on it."""
+        return (time.monotonic_ns() // 1000) & 0x1FFFFFFF
+
+    def open_uart(tx, rx, baudrate):
+        """An asyncio stream over a UART, for `await s.readinto(buf)`."""
+        from asyncio import StreamReader
+
+        return StreamReader(busio.UART(
+            tx, rx, baudrate=baudrate, timeout=0, receiver_buffer_size=256
+        ))
+else:
+    from hal.sim import (
+        gc,
+        board,
+        analogio,
+        bitmaptools,
+        busio,
+        digitalio,
+        displayio,
+        microcontroller,
+        pwmio,
+        socketpool,
+        terminalio,
+        vectorio,
+        wifi,
+        adafruit_focaltouch,
+        adafruit_ili9341,
+    )
+    from hal.sim.ssl import create_default_context as ssl_create_default_context
+    from hal.sim.ticks import ticks_ms, ticks_us, ticks_add, ticks_diff
+    from hal.sim.displayio import RoundRect, Label
+    from hal.sim.serial import open_uart
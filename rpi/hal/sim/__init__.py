@@ -0,0 +1,7 @@
+"""CPython stand-ins for the CircuitPython modules used by the app.
+
+They implement just the surface the application touches. Hardware
+inputs are pluggable: `analogio.set_source()` feeds the ADC channels,
+`adafruit_focaltouch.touches` holds the current touches, and
+`socketpool` wraps real host sockets so a local broker can be used.
+"""
@@ -0,0 +1,81 @@
+"""Run the whole app under CPython against the simulated hardware.
+
+    cd rpi && python -m hal.sim [--duration SECONDS] [--profile]
+        [--drop SECONDS] [--stall SECONDS]
+
+A local broker stand-in takes the place of AWS IoT. With --profile the
+run happens under cProfile and the top entries are printed at the end.
+--drop and --stall have the broker close, or stop answering, the
+connection that many seconds in.
+"""
+import argparse
+import asyncio
+import os
+
+from hal.sim import gc
+from hal.sim.broker import Broker
+
+
+async def outage(broker, drop, stall):
+    if drop is not None:
+        await asyncio.sleep(drop)
+        print('sim: broker drops the connection')
+        broker.drop()
+    if stall is not None:
+        await asyncio.sleep(stall - (drop or 0))
+        print('sim: broker stalls the connection')
+        broker.stall()
+
+
+async def main(duration, broker, drop=None, stall=None):
+    import state
+    import iot
+    import ui
+
+    gc.start()
+    main_state = state.State()
+    cloud = iot.IOT(main_state)
+    interface = ui.UI(main_state, cloud, console=False)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            main_state.update(),
+            interface.run(),
+            cloud.run(),
+            outage(broker, drop, stall),
+        ), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='python -m hal.sim')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--sort', default='cumulative')
+    parser.add_argument('--drop', type=float)
+    parser.add_argument('--stall', type=float)
+    args = parser.parse_args()
+
+    broker = Broker().start()
+    os.environ.setdefault('CLIENT_ID', 'laundrymon-sim')
+    os.environ['BROKER'] = '127.0.0.1'
+    os.environ['BROKER_PORT'] = str(broker.port)
+
+    if args.profile:
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        profile.runcall(asyncio.run, main(args.duration, broker, args.drop,
+                                          args.stall))
+        pstats.Stats(profile).sort_stats(args.sort).print_stats(30)
+    else:
+        asyncio.run(main(args.duration, broker, args.drop, args.stall))
+
+    stats = broker.stats
+    print('broker:', stats.packets, 'in', stats.bytes_in, 'bytes,',
+          'out', stats.bytes_out, 'bytes')
+
+
+run()
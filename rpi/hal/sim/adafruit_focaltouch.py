@@ -0,0 +1,15 @@
+# the current touches, as the driver reports them: [{'x': .., 'y': .., 'id': ..}]
+touches = []
+
+
+class Adafruit_FocalTouch:
+    def __init__(self, i2c, address=0x38, debug=False, irq_pin=None):
+        self.i2c = i2c
+
+    @property
+    def touched(self):
+        return len(touches)
+
+    @property
+    def touches(self):
+        return touches
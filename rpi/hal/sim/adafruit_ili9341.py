@@ -0,0 +1,15 @@
+class ILI9341:
+    def __init__(self, bus, width, height, **kwargs):
+        self.bus = bus
+        self.width = width
+        self.height = height
+        self.auto_refresh = True
+        self.root_group = None
+        self.refreshes = 0
+
+    def show(self, group):
+        self.root_group = group
+
+    def refresh(self, **kwargs):
+        self.refreshes += 1
+        return True
@@ -0,0 +1,29 @@
+import random
+
+# pin -> callable returning the next 16-bit reading
+sources = {}
+
+
+def set_source(pin, source):
+    sources[pin] = source
+
+
+def noise(level=1000, spread=50):
+    return lambda: level + random.randint(-spread, spread)
+
+
+class AnalogIn:
+    reference_voltage = 3.3
+
+    def __init__(self, pin):
+        self.pin = pin
+
+    @property
+    def value(self):
+        source = sources.get(self.pin)
+        if source is None:
+            source = sources[self.pin] = noise()
+        return max(0, min(65535, int(source())))
+
+    def deinit(self):
+        pass
@@ -0,0 +1,17 @@
+class Pin:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'board.{self.name}'
+
+
+for _i in range(29):
+    globals()[f'GP{_i}'] = Pin(f'GP{_i}')
+
+GP26_A0 = GP26
+GP27_A1 = GP27
+GP28_A2 = GP28
+A0, A1, A2 = GP26, GP27, GP28
+D1 = GP1
+LED = Pin('LED')
@@ -0,0 +1,141 @@
+"""A minimal MQTT 3.1.1 broker stand-in for local runs and benchmarks.
+
+It acknowledges CONNECT, SUBSCRIBE, QoS 1 PUBLISH and PINGREQ, keeps
+what was published, and counts packets and bytes in each direction. It
+runs in its own thread because the client's socket calls block. Set
+`latency` to answer that many seconds late, as a distant broker would,
+and `drop_pubacks` to lose that many PUBACKs, to exercise retransmission;
+drop() and stall() cut off or silence the connected clients, to
+exercise the link supervisor (link.py).
+"""
+import socket
+import socketserver
+import threading
+import time
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reads = 0
+        self.packets = {}
+        self.published = []
+        self.duplicates = 0
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.buf = bytearray()
+        self.server.clients.append(self.request)
+
+    def finish(self):
+        self.server.clients.remove(self.request)
+
+    def send(self, data):
+        if self.request in self.server.stalled:
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.stats.bytes_out += len(data)
+        self.request.sendall(data)
+
+    def packet(self):
+        # -> (header byte, body) once a whole packet is buffered
+        n, sh, i = 0, 0, 1
+        while True:
+            if i >= len(self.buf):
+                return None
+            b = self.buf[i]
+            n |= (b & 0x7F) << sh
+            i += 1
+            if not b & 0x80:
+                break
+            sh += 7
+        if len(self.buf) < i + n:
+            return None
+        rv = (self.buf[0], bytes(self.buf[i:i + n]))
+        del self.buf[:i + n]
+        return rv
+
+    def handle(self):
+        stats = self.server.stats
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            stats.reads += 1
+            stats.bytes_in += len(data)
+            self.buf.extend(data)
+            while (pkt := self.packet()) is not None:
+                op, body = pkt
+                kind = op & 0xF0
+                stats.packets[kind] = stats.packets.get(kind, 0) + 1
+                if kind == 0x10:
+                    self.send(b'\x20\x02\x00\x00')
+                elif kind == 0x80:
+                    self.send(b'\x90\x03' + body[:2] + b'\x00')
+                elif kind == 0x30:
+                    tlen = body[0] << 8 | body[1]
+                    topic = body[2:2 + tlen]
+                    rest = body[2 + tlen:]
+                    if op & 8:
+                        stats.duplicates += 1
+                    if op & 6:
+                        if self.server.drop_pubacks:
+                            self.server.drop_pubacks -= 1
+                        else:
+                            self.send(b'\x40\x02' + rest[:2])
+                        rest = rest[2:]
+                    stats.published.append((topic, rest))
+                elif kind == 0xC0:
+                    self.send(b'\xd0\x00')
+                elif kind == 0xE0:
+                    return
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.stats = Stats()
+        self.clients = []
+        self.stalled = []
+        self.drop_pubacks = 0
+        self.latency = 0.0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def drop(self):
+        """Close every client connection."""
+        for client in list(self.clients):
+            client.shutdown(socket.SHUT_RDWR)
+
+    def stall(self):
+        """Stop answering the clients connected now, leaving their
+        sockets open, as a half-open link would."""
+        self.stalled.extend(self.clients)
+
+    def publish(self, topic, msg):
+        """Deliver a QoS 0 message to every connected client."""
+        body = len(topic).to_bytes(2, 'big') + topic + msg
+        n, sz = bytearray(), len(body)
+        while True:
+            b = sz & 0x7F
+            sz >>= 7
+            n.append(b | (0x80 if sz else 0))
+            if not sz:
+                break
+        for client in list(self.clients):
+            client.sendall(b'\x30' + n + body)
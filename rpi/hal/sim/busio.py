@@ -0,0 +1,37 @@
+class SPI:
+    def __init__(self, clock, MOSI=None, MISO=None):
+        self.clock = clock
+        self.MOSI = MOSI
+        self.MISO = MISO
+
+
+class I2C:
+    def __init__(self, scl, sda, frequency=100000):
+        self.scl = scl
+        self.sda = sda
+
+
+class UART:
+    def __init__(self, tx=None, rx=None, baudrate=9600, timeout=1,
+                 receiver_buffer_size=64):
+        self.tx = tx
+        self.rx = rx
+        self.baudrate = baudrate
+        self.rx_buffer = bytearray()
+        self.tx_buffer = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx_buffer)
+
+    def readinto(self, buf, nbytes=None):
+        n = min(len(buf) if nbytes is None else nbytes, len(self.rx_buffer))
+        if not n:
+            return None
+        buf[:n] = self.rx_buffer[:n]
+        del self.rx_buffer[:n]
+        return n
+
+    def write(self, buf):
+        self.tx_buffer.extend(buf)
+        return len(buf)
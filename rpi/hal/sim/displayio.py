@@ -0,0 +1,102 @@
+class Palette:
+    def __init__(self, color_count):
+        self.colors = [0] * color_count
+
+    def __getitem__(self, index):
+        return self.colors[index]
+
+    def __setitem__(self, index, value):
+        self.colors[index] = value
+
+    def __len__(self):
+        return len(self.colors)
+
+
+class Bitmap:
+    def __init__(self, width, height, value_count):
+        self.width = width
+        self.height = height
+        self.data = bytearray(width * height)
+
+    def __getitem__(self, pos):
+        x, y = pos
+        return self.data[y * self.width + x]
+
+    def __setitem__(self, pos, value):
+        x, y = pos
+        self.data[y * self.width + x] = value
+
+
+class TileGrid:
+    def __init__(self, bitmap, pixel_shader, x=0, y=0, **kwargs):
+        self.bitmap = bitmap
+        self.pixel_shader = pixel_shader
+        self.x = x
+        self.y = y
+        self.hidden = False
+
+
+class Group:
+    def __init__(self, scale=1, x=0, y=0):
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.hidden = False
+        self.items = []
+
+    def append(self, layer):
+        self.items.append(layer)
+
+    def remove(self, layer):
+        self.items.remove(layer)
+
+    def __contains__(self, layer):
+        return layer in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+
+class FourWire:
+    def __init__(self, spi_bus, command=None, chip_select=None, reset=None):
+        self.spi_bus = spi_bus
+
+
+CIRCUITPYTHON_TERMINAL = Group()
+
+
+def release_displays():
+    pass
+
+
+class Label:
+    """adafruit_display_text.bitmap_label.Label"""
+
+    def __init__(self, font, text='', color=0xFFFFFF, scale=1, **kwargs):
+        self.font = font
+        self.text = text
+        self.color = color
+        self.scale = scale
+        self.x = 0
+        self.y = 0
+        self.anchor_point = None
+        self.anchored_position = None
+        self.hidden = False
+
+
+class RoundRect:
+    """adafruit_display_shapes.roundrect.RoundRect"""
+
+    def __init__(self, x, y, width, height, r, fill=None, outline=None,
+                 stroke=1):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.r = r
+        self.fill = fill
+        self.outline = outline
+        self.hidden = False
@@ -0,0 +1,34 @@
+"""CircuitPython's gc module, with the heap figures taken from tracemalloc.
+
+Call `start()` to begin tracing; until then mem_alloc() reports 0.
+Memory already in use at start() doesn't count, so the figures are
+about what the app allocates rather than the interpreter.
+"""
+import gc as _gc
+import tracemalloc
+
+collect = _gc.collect
+enable = _gc.enable
+disable = _gc.disable
+isenabled = _gc.isenabled
+
+# roughly what is left for the application on an RP2040
+HEAP_SIZE = 192 * 1024
+
+_baseline = 0
+
+
+def start():
+    global _baseline
+    tracemalloc.start()
+    _baseline = tracemalloc.get_traced_memory()[0]
+
+
+def mem_alloc():
+    if not tracemalloc.is_tracing():
+        return 0
+    return max(0, tracemalloc.get_traced_memory()[0] - _baseline)
+
+
+def mem_free():
+    return max(0, HEAP_SIZE - mem_alloc())
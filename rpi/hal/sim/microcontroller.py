@@ -0,0 +1,16 @@
+import time
+
+
+class ResetError(SystemExit):
+    pass
+
+
+nvm = bytearray(4096)
+
+
+def delay_us(delay):
+    time.sleep(delay / 1_000_000)
+
+
+def reset():
+    raise ResetError('microcontroller.reset()')
@@ -0,0 +1,5 @@
+class PWMOut:
+    def __init__(self, pin, duty_cycle=0, frequency=500):
+        self.pin = pin
+        self.duty_cycle = duty_cycle
+        self.frequency = frequency
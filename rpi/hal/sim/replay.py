@@ -0,0 +1,152 @@
+"""Replay recorded washer traces through Sampler and AutoState.
+
+    cd rpi && python -m hal.sim.replay TRACE [--detector goertzel]
+    cd rpi && python -m hal.sim.replay TRACE --synthesize --cycles 5
+
+Replay runs on trace time rather than the wall clock, so hours of
+laundry take seconds. It reports detection latency against the markers
+in the trace (lid lock -> Running, cycle complete -> Done), transitions
+that match no marker, and CPU time per simulated second. Traces are
+recorded on the device with TRACE_PATH set; the markers are whatever
+was annotated while recording, so a trace without them reports every
+transition as false.
+"""
+import argparse
+import math
+import random
+import time
+
+import sensors
+import state
+import trace
+from hal.sim.ticks import _TICKS_MAX
+
+# how long after a marker a transition still counts as detecting it
+MATCH_WINDOW = 120.0
+
+
+def replay(path, detector='peak', step_interval=1.0):
+    alarm = state.AlarmState()
+    auto = state.AutoState(alarm, detector=detector)
+
+    marks = []
+    transitions = []
+    next_step = 0.0
+    next_sample = 0.0
+    now = 0.0
+    start = time.process_time()
+    for record in trace.read_trace(path):
+        now = record[1] / 1000
+        if record[0] == 'mark':
+            marks.append((now, record[2]))
+            continue
+
+        # the trace is taken at full rate; skip the bursts that the
+        # sampling policy would not have taken
+        if now < next_sample:
+            continue
+        auto.sampler.replay(record[1] & _TICKS_MAX, *record[3])
+        next_sample = now + auto.sampler.interval - 0.001
+        if now >= next_step:
+            before = auto.washer_state
+            auto.step(now)
+            if auto.washer_state != before:
+                transitions.append((now, auto.washer_state))
+            next_step = now + max(step_interval, auto.sampler.interval)
+    cpu = time.process_time() - start
+
+    print('suppressed flaps:', auto.washer.suppressed)
+    print('samples per hour:', auto.sampling.per_hour)
+    return report(marks, transitions, now, cpu)
+
+
+def report(marks, transitions, duration, cpu):
+    wanted = {'Running': 'lid_locked', 'Done': 'cycle_complete'}
+    pending = list(marks)
+    latency = {'Running': [], 'Done': []}
+    false = []
+    for t, new_state in transitions:
+        if new_state not in wanted:
+            continue
+        for mark in pending:
+            mt, event = mark
+            if event == wanted[new_state] and 0 <= t - mt <= MATCH_WINDOW:
+                latency[new_state].append(t - mt)
+                pending.remove(mark)
+                break
+        else:
+            false.append((t, new_state))
+    missed = [m for m in pending if m[1] in wanted.values()]
+
+    print(f'simulated {duration / 3600:.2f} h in {cpu:.2f} s CPU '
+          f'({1000 * cpu / max(duration, 1e-9):.3f} ms CPU per simulated s, '
+          f'{duration / max(cpu, 1e-9):.0f}x real time)')
+    for new_state, values in latency.items():
+        if values:
+            print(f'{wanted[new_state]} -> {new_state}: {len(values)} '
+                  f'detected, latency mean {sum(values) / len(values):.1f} s,'
+                  f' max {max(values):.1f} s')
+    print('false transitions:', len(false), false[:10])
+    print('missed events:', len(missed), missed[:10])
+    return latency, false, missed
+
+
+def synthesize(path, cycles=3, detector='peak', seed=1):
+    """Write a trace of `cycles` washes with a 250 Hz LED flicker, plus
+    the occasional noise spike."""
+    rng = random.Random(seed)
+    sampler = sensors.Sampler(detector)
+    samples, spacing_us = sampler.samples, sampler.spacing_us
+    writer = trace.TraceWriter(path)
+    # start near the top of the ticks range to exercise the wraparound
+    ticks = _TICKS_MAX - 60_000
+    bufs = [sampler.cycle_complete_buf, sampler.blank_buf,
+            sampler.lid_locked_buf]
+
+    def led(on, t):
+        if not on:
+            return 0
+        return 9000 * max(0.0, math.sin(2 * math.pi * 250 * t))
+
+    def run(seconds, lid, done):
+        nonlocal ticks
+        for n in range(int(seconds / sampler.interval)):
+            spike = rng.random() < 0.001
+            for i in range(samples):
+                t = ticks / 1000 + i * spacing_us / 1_000_000
+                blank = 1000 + rng.randint(-40, 40)
+                bufs[0][i] = int(blank + led(done, t))
+                bufs[1][i] = blank
+                bufs[2][i] = int(blank + led(lid, t)
+                                 + (6000 if spike else 0))
+            writer.write(ticks, spacing_us, *bufs)
+            ticks = (ticks + int(sampler.interval * 1000)) & _TICKS_MAX
+
+    for i in range(cycles):
+        run(rng.uniform(300, 900), False, False)
+        writer.mark(ticks, 'lid_locked')
+        run(rng.uniform(1800, 3600), True, False)
+        writer.mark(ticks, 'cycle_complete')
+        run(rng.uniform(120, 600), False, True)
+    run(300, False, False)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m hal.sim.replay')
+    parser.add_argument('trace')
+    parser.add_argument('--detector', default='peak',
+                        choices=('peak', 'goertzel'))
+    parser.add_argument('--synthesize', action='store_true',
+                        help='write a synthetic trace first')
+    parser.add_argument('--cycles', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.synthesize:
+        open(args.trace, 'wb').close()
+        synthesize(args.trace, args.cycles, args.detector)
+    replay(args.trace, args.detector)
+
+
+if __name__ == '__main__':
+    main()
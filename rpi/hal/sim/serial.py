@@ -0,0 +1,66 @@
+"""UART streams on the host: a pty or serial device, or a loopback pipe.
+
+Register a path in `ports` under the RX pin to read from a pty. Otherwise
+`open_uart` makes a pipe and leaves its write end in `loopbacks`, so
+frames can be injected with `os.write(loopbacks[pin], data)`.
+"""
+import asyncio
+import os
+
+ports = {}
+loopbacks = {}
+
+
+class SerialStream:
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+
+    async def readinto(self, buf):
+        while True:
+            try:
+                data = os.read(self.fd, len(buf))
+            except BlockingIOError:
+                data = None
+            if data:
+                buf[:len(data)] = data
+                return len(data)
+            if data == b'':
+                # nobody has the other end open yet, or it went away
+                await asyncio.sleep(0.05)
+                continue
+            ready = asyncio.get_running_loop().create_future()
+            asyncio.get_running_loop().add_reader(
+                self.fd, ready.set_result, None
+            )
+            try:
+                await ready
+            finally:
+                asyncio.get_running_loop().remove_reader(self.fd)
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+
+def open_uart(tx, rx, baudrate):
+    path = ports.get(rx)
+    if path:
+        import tty
+
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        if os.isatty(fd):
+            tty.setraw(fd)
+        return SerialStream(fd)
+
+    read_fd, write_fd = os.pipe()
+    loopbacks[rx] = write_fd
+    return SerialStream(read_fd)
+
+
+def dryer_frame(status, remaining=0):
+    """Encode a dryer status frame, see sensors.Dryer."""
+    payload = bytes((status, remaining >> 8, remaining & 0xFF))
+    chk = len(payload)
+    for b in payload:
+        chk ^= b
+    return bytes((0x02, len(payload))) + payload + bytes((chk,))
@@ -0,0 +1,48 @@
+"""socketpool on top of host sockets, so a local broker can stand in."""
+import socket
+
+
+class Socket:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def connect(self, address):
+        self.sock.connect(address)
+
+    def send(self, data):
+        # CircuitPython sockets take the whole buffer, and accept str
+        if isinstance(data, str):
+            data = data.encode()
+        if self.sock.gettimeout() == 0:
+            # non-blocking: may be partial, like the device
+            return self.sock.send(data)
+        self.sock.sendall(data)
+        return len(data)
+
+    def recv_into(self, buf, nbytes=0):
+        return self.sock.recv_into(buf, nbytes)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def settimeout(self, value):
+        self.sock.settimeout(value)
+
+    def close(self):
+        self.sock.close()
+
+
+class SocketPool:
+    AF_INET = socket.AF_INET
+    SOCK_STREAM = socket.SOCK_STREAM
+
+    def __init__(self, radio):
+        self.radio = radio
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        return socket.getaddrinfo(host, port, socket.AF_INET,
+                                  socket.SOCK_STREAM)
+
+    def socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM,
+               proto=0):
+        return Socket(socket.socket(family, type, proto))
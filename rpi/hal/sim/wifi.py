@@ -0,0 +1,16 @@
+class Radio:
+    def __init__(self):
+        self.connected = False
+        self.ipv4_address = None
+        self.enabled = True
+
+    def connect(self, ssid, password=None, **kwargs):
+        self.connected = True
+        self.ipv4_address = '127.0.0.1'
+
+    def disconnect(self):
+        self.connected = False
+        self.ipv4_address = None
+
+
+radio = Radio()
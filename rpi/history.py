@@ -0,0 +1,136 @@
+"""Completed washer and dryer cycles, kept in a ring buffer in NVM.
+
+Aggregates per kind of cycle are updated as cycles are added, so the
+estimate of time remaining never has to scan the history. The median is
+a running approximation: it moves a step towards every new duration.
+
+time.monotonic() restarts from zero on reset, so records keep their own
+clock: monotonic seconds plus a shift, with the clock at the last write
+kept in the header. On load the shift is set so the clock goes on from
+there, and times are reported back in monotonic seconds. As in the
+journal, the time between the last write and the reset is lost.
+"""
+import struct
+import time
+
+from hal import microcontroller
+from changes import ChangeMixin
+
+# magic, head, count, clock
+HEADER = '<4sBBi'
+HEADER_SIZE = struct.calcsize(HEADER)
+# start, finish (clock seconds), duration (seconds), kind
+RECORD = '<iiIB'
+RECORD_SIZE = struct.calcsize(RECORD)
+MAGIC = b'LMH2'
+
+# kind bits: the dryer rather than the washer, a manual timer
+WASHER = 0
+DRYER = 1
+MANUAL = 2
+KINDS = ('washer', 'dryer', 'manual_washer', 'manual_dryer')
+
+
+class Stats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0
+        self.median = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.mean += (duration - self.mean) / self.count
+        if self.count == 1:
+            self.median = duration
+        else:
+            step = max(self.mean / 8, 1)
+            if duration > self.median:
+                self.median = min(self.median + step, duration)
+            elif duration < self.median:
+                self.median = max(self.median - step, duration)
+
+
+class History(ChangeMixin):
+    report_paths = {'last': ('last',), 'stats': ('stats',)}
+    size = 32
+    # where the ring lives in nvm, after the state journal
+    offset = 128
+
+    def __init__(self, nvm=None):
+        self.nvm = microcontroller.nvm if nvm is None else nvm
+        self.head = 0
+        self.count = 0
+        # clock - time.monotonic()
+        self.shift = 0
+        self.stats = [Stats() for kind in KINDS]
+        self.last = None
+        self.load()
+
+    def _pos(self, i):
+        return self.offset + HEADER_SIZE + i * RECORD_SIZE
+
+    def load(self):
+        pos = self.offset
+        magic, head, count, clock = struct.unpack(
+            HEADER, bytes(self.nvm[pos:pos + HEADER_SIZE])
+        )
+        if magic != MAGIC or head >= self.size or count > self.size:
+            return
+        self.head, self.count = head, count
+        self.shift = clock - int(time.monotonic())
+        for record in self.records():
+            self.stats[record[3]].add(record[2])
+            self.last = record
+
+    def records(self):
+        """Oldest first, with times in monotonic seconds."""
+        for i in range(self.count):
+            pos = self._pos((self.head - self.count + i) % self.size)
+            start, finish, duration, kind = struct.unpack(
+                RECORD, bytes(self.nvm[pos:pos + RECORD_SIZE])
+            )
+            yield (start - self.shift, finish - self.shift, duration, kind)
+
+    def add(self, kind, start, finish):
+        record = (int(start), int(finish), max(0, int(finish - start)), kind)
+        pos = self._pos(self.head)
+        self.nvm[pos:pos + RECORD_SIZE] = struct.pack(
+            RECORD, record[0] + self.shift, record[1] + self.shift,
+            record[2], kind
+        )
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        pos = self.offset
+        self.nvm[pos:pos + HEADER_SIZE] = struct.pack(
+            HEADER, MAGIC, self.head, self.count,
+            int(time.monotonic()) + self.shift
+        )
+        self.stats[kind].add(record[2])
+        self.last = record
+        self.mark('last', 'stats')
+
+    def remaining(self, kind, elapsed):
+        """Estimated seconds left in a cycle `elapsed` seconds along, or
+        None without any history."""
+        stats = self.stats[kind]
+        if not stats.count:
+            return None
+        return max(0, stats.median - elapsed)
+
+    def report_value(self, field):
+        if field == 'last':
+            if self.last is None:
+                return None
+            return [KINDS[self.last[3]], self.last[0], self.last[1],
+                    self.last[2]]
+        return {
+            KINDS[i]: [s.count, int(s.mean), int(s.median)]
+            for i, s in enumerate(self.stats) if s.count
+        }
+
+    @property
+    def reported(self):
+        return {
+            "last": self.report_value('last'),
+            "stats": self.report_value('stats'),
+        }
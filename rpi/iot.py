@@ -1,32 +1,27 @@
-import gc
 import time
 from os import getenv
-from ssl import create_default_context as ssl_create_default_context
 import json
-import wifi
-from socketpool import SocketPool
-from asyncio import sleep
+from asyncio import sleep, Event, TimeoutError, wait_for
 
-from umqtt import MQTTClient
-
-
-def dict_difference(a, b):
-    if not a:
-        return b
-    rv = {}
-    for k in a:
-        if isinstance(a[k], dict):
-            v = dict_difference(a[k], b[k])
-            if v:
-                rv[k] = v
-        elif b[k] != a[k]:
-            rv[k] = b[k]
-    return rv
+from hal import wifi, socketpool, ssl_create_default_context
+from memstats import mem
+from outbox import Outbox
+from publishing import PublishPolicy
+from shadow import Shadow, partial
+from link import LinkSupervisor
+from umqtt import AsyncMQTTClient
 
 
 class IOT:
     PUB_CHANNEL = f'$aws/things/{getenv("CLIENT_ID")}/shadow/update'
     SUB_CHANNEL = f'$aws/things/{getenv("CLIENT_ID")}/shadow/update/delta'
+    TELEMETRY_CHANNEL = f'laundrymon/{getenv("CLIENT_ID")}/telemetry'
+    # seconds between batched telemetry uploads
+    telemetry_interval = 60.0
+    # MQTT keepalive, seconds; the client pings when idle for half that
+    keepalive = 60
+    # longest wait between looks at the state, seconds
+    tick = 4.0
     
     def __init__(self, state):
         self.state = state
@@ -38,7 +33,19 @@ class IOT:
             'subscribe': False,
             'published': False,
         }
-        self.last_reported = {}
+        self.mqtt = None
+        self.pool = None
+        self.link = LinkSupervisor(self)
+        self.shadow = Shadow()
+        # patches not yet published, coalesced
+        self.outbox = Outbox(spill=bool(int(getenv('OUTBOX_SPILL', 0))))
+        self.desired_pending = False
+        self.publisher = PublishPolicy()
+        # alarm transitions wake the loop rather than wait for the tick
+        self.wake = Event()
+        state.alarm_state.listener = self.wake.set
+        # state version covered by the outbox
+        self.reported_version = 0
 
     @property
     def connected(self):
@@ -58,6 +65,17 @@ class IOT:
         
         This should only be called once per system boot.
         """
+        await self.link.recover(cold=True)
+
+    async def rejoin(self):
+        """Associate with the access point, dropping any stale
+        association first."""
+        self.status['wifi'] = False
+        self.status['ssl'] = False
+        if wifi.radio.connected:
+            wifi.radio.enabled = False
+            await sleep(0.5)
+            wifi.radio.enabled = True
         wifi.radio.connect(
             getenv('CIRCUITPY_WIFI_SSID'),
             getenv('CIRCUITPY_WIFI_PASSWORD'),
@@ -66,8 +84,14 @@ class IOT:
         print('Wifi connected')
         self.status['wifi'] = True
         await sleep(0)
-        
-        self.pool = SocketPool(wifi.radio)
+
+    async def rebuild(self):
+        """A fresh socket pool and TLS context."""
+        self.status['ssl'] = False
+        self.pool = None
+        self.ssl_context = None
+        mem.collect()
+        self.pool = socketpool.SocketPool(wifi.radio)
         self.ssl_context = ssl_create_default_context()
 
         self.ssl_context.load_cert_chain(
@@ -78,42 +102,48 @@ class IOT:
         print('SSL setup')
         self.status['ssl'] = True
         await sleep(0)
-
-        await self.start_mqtt()        
         
     async def start_mqtt(self):
         """Start the MQTT connection.
 
-        This can be called any time a reconnection is needed.
-        """        
-        self.mqtt = MQTTClient(
-            client_id=getenv('CLIENT_ID'),
-            server=getenv('BROKER'),
-            keepalive=10000,
-            socket_pool=self.pool,
-            ssl=True,
-            ssl_context=self.ssl_context,
-        )
-        self.mqtt.set_callback(self.handle_message)
+        This can be called any time a reconnection is needed. The client
+        is kept across reconnections, so QoS 1 publishes still waiting
+        for their PUBACK are sent again.
+        """
+        if self.mqtt is None:
+            self.mqtt = AsyncMQTTClient(
+                client_id=getenv('CLIENT_ID'),
+                server=getenv('BROKER'),
+                port=int(getenv('BROKER_PORT', 0)),
+                keepalive=self.keepalive,
+                socket_pool=self.pool,
+                ssl=True,
+                ssl_context=self.ssl_context,
+            )
+            self.mqtt.set_callback(self.handle_message)
+        else:
+            self.mqtt.socket_pool = self.pool
+            self.mqtt.ssl_context = self.ssl_context
 
         print('MQTT client configured')
         self.status['mqtt'] = True
         await sleep(0)
         
-        self.mqtt.connect()
+        await self.mqtt.connect()
 
         print('MQTT connected')
         self.status['connect'] = True
         await sleep(0)
         
-        self.mqtt.subscribe(self.SUB_CHANNEL)
+        await self.mqtt.subscribe(self.SUB_CHANNEL)
 
         print('MQTT subscribed')
         self.status['subscribe'] = True
-        gc.collect()
+        mem.collect()
         await sleep(0)
         
         self.reported_at = -999.0
+        self.telemetry_at = time.monotonic()
         
     def disconnect(self):
         print('MQTT: DISCONNECTING...')
@@ -121,26 +151,45 @@ class IOT:
         self.status['connect'] = False
         self.status['subscribe'] = False
         self.status['published'] = False
-        self.mqtt = None
-        gc.collect()
+        if self.mqtt is not None:
+            self.mqtt.close()
+        mem.collect()
         
     def handle_message(self, topic, msg):
+        # topic and msg are views into the client's receive buffer
+        topic = str(topic, 'utf-8')
+        msg = str(msg, 'utf-8')
         print('MQTT: topic', topic, 'message:')
         print(msg)
-        if topic.decode() == self.SUB_CHANNEL:
-            self.state.handle_delta(json.loads(msg.decode()))
+        if topic == self.SUB_CHANNEL:
+            self.state.handle_delta(json.loads(msg))
 
-    def reported_state(self):
+    def reported_state(self, full=False):
+        """The shadow patch for what changed since the last publish, built
+        from the marked fields alone. With `full`, every section is
+        rebuilt, to pick up the sensor readings that change without being
+        marked."""
+        changes = self.state.changes_since(self.reported_version)
         current = {
             "now": time.monotonic(),
             "mode": self.state.mode,
-            "auto": self.state.auto_state.reported,
-            "manual": self.state.manual_state.reported,
-            "alarm": self.state.alarm_state.reported,
         }
-        delta = dict_difference(self.last_reported, current)
+        for section, obj in (
+                ("auto", self.state.auto_state),
+                ("manual", self.state.manual_state),
+                ("alarm", self.state.alarm_state),
+                ("history", self.state.history),
+        ):
+            if full:
+                current[section] = obj.reported
+            elif section in changes:
+                current[section] = partial(obj, changes[section])
+        if full:
+            current["mem"] = mem.summary
+            current["link"] = self.link.summary
+            current["publishing"] = self.publisher.summary
+        delta = self.shadow.update(current, prune=full)
         print(delta)
-        self.last_reported = current
         return delta
 
     def desired_state(self):
@@ -148,34 +197,108 @@ class IOT:
             "alarm": self.state.alarm_state.desired,
         }
 
-    def publish(self, desired=False):
+    def queue(self, desired=False, full=False, urgent=False):
+        """Put what changed in the outbox; it goes out with the next
+        publish, merged with whatever else is waiting."""
+        self.outbox.add(self.reported_state(full))
+        self.desired_pending |= desired
+        if full:
+            self.reported_at = time.monotonic()
+        self.publisher.changed(time.monotonic(), urgent)
+
+    async def publish(self):
+        """Send the outbox as one shadow update."""
+        if self.outbox.overflowed:
+            # too much piled up to track: send the whole document
+            self.outbox.clear()
+            self.shadow.clear()
+            self.queue(full=True)
         msg = {
-            "state": {"reported": self.reported_state()}
+            "state": {"reported": self.outbox.pending}
         }
-        if desired:
+        if self.desired_pending:
             msg['state']['desired'] = self.desired_state()
-        self.mqtt.publish(
+        # the client streams the JSON into its send buffer
+        await self.mqtt.publish(
             topic=self.PUB_CHANNEL,
-            msg=json.dumps(msg).encode(),
-            qos=0
+            msg=msg,
+            qos=1
         )
         print('MQTT: message published')
-        self.reported_at = time.monotonic()
+        self.publisher.sent('shadow', self.mqtt.payload_size)
+        self.outbox.clear()
+        self.desired_pending = False
         self.status['published'] = True
+
+    async def publish_telemetry(self):
+        telemetry = self.state.auto_state.telemetry
+        if telemetry.pending:
+            await self.mqtt.publish(
+                topic=self.TELEMETRY_CHANNEL,
+                msg=telemetry.batch(),
+                qos=0
+            )
+            print('MQTT: telemetry published')
+            self.publisher.sent('telemetry', self.mqtt.payload_size)
+        self.telemetry_at = time.monotonic()
     
     async def run(self):
         await self.boot()
         
         while True:
+            # cleared before the state is read, so an alarm marked while
+            # this iteration awaits a publish still cuts the wait short
+            self.wake.clear()
+            start = mem.begin()
+            online = self.link.online
+            try:
+                # changes are queued while offline too, and go out as
+                # one message once the link supervisor has it back
+                version = self.state.latest_version
+                changed = self.state.should_report_now(self.reported_version)
+                full = online and time.monotonic() - self.reported_at > 60.0
+                if changed or full:
+                    urgent = 'state' in self.state.alarm_state.changed_since(
+                        self.reported_version)
+                    self.queue(changed, full, urgent)
+                    self.reported_version = version
+
+                if not online:
+                    self.outbox.save()
+                else:
+                    # other tasks run during the publishes, so only the
+                    # slices around them are charged to iot
+                    if (self.outbox.pending or self.outbox.overflowed) \
+                            and self.publisher.due(time.monotonic()):
+                        mem.end('iot', start, last=False)
+                        try:
+                            await self.publish()
+                        finally:
+                            start = mem.begin()
+
+                    if time.monotonic() - self.telemetry_at > \
+                            self.telemetry_interval:
+                        mem.end('iot', start, last=False)
+                        try:
+                            await self.publish_telemetry()
+                        finally:
+                            start = mem.begin()
+
+                    # incoming messages are handled by the client's
+                    # reader task; this surfaces a dropped connection
+                    self.mqtt.check()
+            except Exception as error:
+                print('MQTT: link lost:', error)
+                self.link.lost()
+
+            mem.end('iot', start)
+            # nothing can go out while offline, so the debounce is moot
+            wait = None
+            if self.link.online:
+                wait = self.publisher.wait(time.monotonic())
             try:
-                changed = self.state.should_report_now()
-                if changed or time.monotonic() - self.reported_at > 60.0:
-                    self.publish(changed)
-            
-                self.mqtt.check_msg()
-            except:
-                self.disconnect()
-                await sleep(15.0)
-                await self.start_mqtt()
-            
-            await sleep(4.0)
+                await wait_for(self.wake.wait(),
+                               self.tick if wait is None
+                               else min(self.tick, max(wait, 0.1)))
+            except TimeoutError:
+                pass
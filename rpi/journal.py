@@ -0,0 +1,173 @@
+"""Persistent state journal in microcontroller.nvm.
+
+A fixed-layout record is written to one of two slots in turn, so an
+interrupted write still leaves the other slot to restore from. Writes
+are coalesced: the journal is checked on a timer and only written when
+the state has changed, or every `refresh` seconds while something is
+running so the elapsed times stay close.
+
+Times are stored as whole seconds of time.monotonic(), along with the
+time the record was written, and a bit for each that is set at all: after
+a restore a time may take any value, negative ones included. monotonic() restarts from zero on reset,
+so on restore they are shifted to keep their offset from that `now`.
+Everything between the last write and the restore is lost, reboot
+included: while a cycle or timer runs that is up to `refresh` seconds,
+by which elapsed times come back short and timers run late. Writing
+more often would wear the flash for little gain.
+"""
+import struct
+import time
+
+from hal import microcontroller
+
+# magic, seq, mode, auto washer, auto dryer, manual washer, manual dryer,
+# alarm, alarm messages, times present, now, washer started, washer
+# finished, manual washer timeout, manual dryer timeout, snooze until,
+# checksum
+RECORD = '<4sHBBBBBBBBIiiiiiH'
+RECORD_SIZE = struct.calcsize(RECORD)
+MAGIC = b'LMJ2'
+
+MODES = ('Auto', 'Manual')
+STATES = ('Idle', 'Running', 'Done')
+ALARM_STATES = ('Idle', 'Alarm', 'Snooze')
+# the alarm messages are kept as bits; others (e.g. from the cloud) are not
+MESSAGES = (
+    'Washer cycle complete',
+    'Dryer cycle complete',
+    'Washer timer done',
+    'Dryer timer done',
+)
+
+
+def _checksum(data):
+    return sum(data) & 0xFFFF
+
+
+class Journal:
+    # seconds between checks for changes
+    interval = 5.0
+    # rewrite this often while a cycle or timer is running
+    refresh = 600
+
+    def __init__(self, state, nvm=None):
+        self.state = state
+        self.nvm = microcontroller.nvm if nvm is None else nvm
+        self.seq = 0
+        self.last = None
+        self.written_at = 0
+        self.writes = 0
+        self.restored = False
+
+    def _slot(self, i):
+        return i * RECORD_SIZE
+
+    def load(self):
+        """The newest valid record, or None."""
+        best = None
+        for i in range(2):
+            pos = self._slot(i)
+            data = bytes(self.nvm[pos:pos + RECORD_SIZE])
+            if data[:4] != MAGIC:
+                continue
+            record = struct.unpack(RECORD, data)
+            if record[-1] != _checksum(data[:-2]):
+                continue
+            # sequence numbers wrap, so compare them modulo 2 ** 16
+            if best is None or (record[1] - best[1]) & 0xFFFF < 0x8000:
+                best = record
+        return best
+
+    def restore(self):
+        record = self.load()
+        if record is None:
+            return False
+        (_, self.seq, mode, auto_washer, auto_dryer, manual_washer,
+         manual_dryer, alarm, messages, present, then, started, finished,
+         washer_timeout, dryer_timeout, snooze_until, _) = record
+        shift = time.monotonic() - then
+
+        def at(t, i):
+            # bit i of `present` is the i-th time in the record
+            return t + shift if present & (1 << i) else None
+
+        state = self.state
+        state.mode = MODES[mode]
+        state.auto_state.restore(
+            STATES[auto_washer], at(started, 0), at(finished, 1),
+            STATES[auto_dryer],
+        )
+        state.manual_state.restore(
+            STATES[manual_washer], at(washer_timeout, 2),
+            STATES[manual_dryer], at(dryer_timeout, 3),
+        )
+        state.alarm_state.restore(
+            ALARM_STATES[alarm],
+            set(m for i, m in enumerate(MESSAGES) if messages & (1 << i)),
+            at(snooze_until, 4),
+        )
+        # the shifted times encode differently, but the slot already
+        # holds this state: no need to write it again until it changes
+        self.last = self._key(self.encode())
+        self.written_at = time.monotonic()
+        self.restored = True
+        return True
+
+    def _key(self, record):
+        # everything but seq, now and the checksum
+        return record[2:10] + record[11:16]
+
+    def encode(self):
+        state = self.state
+        auto, manual, alarm = (
+            state.auto_state, state.manual_state, state.alarm_state
+        )
+
+        times = (
+            auto.washer_started,
+            auto.washer_finished,
+            manual.washer_timeout or None,
+            manual.dryer_timeout or None,
+            alarm.snooze_until,
+        )
+        present = 0
+        for i, v in enumerate(times):
+            if v is not None:
+                present |= 1 << i
+
+        messages = 0
+        for i, m in enumerate(MESSAGES):
+            if m in alarm.messages:
+                messages |= 1 << i
+        return (
+            MAGIC, self.seq,
+            MODES.index(state.mode),
+            STATES.index(auto.washer_state),
+            STATES.index(auto.dryer_state),
+            STATES.index(manual.washer_state),
+            STATES.index(manual.dryer_state),
+            ALARM_STATES.index(alarm.state),
+            messages,
+            present,
+            int(time.monotonic()),
+        ) + tuple(0 if v is None else int(v) for v in times) + (0,)
+
+    def save(self, force=False):
+        record = self.encode()
+        key = self._key(record)
+        now = time.monotonic()
+        if not force and key == self.last and (
+                not self.state.busy or now - self.written_at < self.refresh
+        ):
+            return False
+
+        self.seq = (self.seq + 1) & 0xFFFF
+        data = bytearray(struct.pack(RECORD, MAGIC, self.seq, *record[2:]))
+        struct.pack_into('<H', data, RECORD_SIZE - 2,
+                         _checksum(data[:-2]))
+        pos = self._slot(self.seq % 2)
+        self.nvm[pos:pos + RECORD_SIZE] = data
+        self.last = key
+        self.written_at = now
+        self.writes += 1
+        return True
@@ -0,0 +1,99 @@
+"""JSON encoding straight into a writer, without building the text.
+
+dump(obj, write) walks dicts, lists, tuples, strings, numbers, booleans
+and None, and calls write() with each piece of the document in order,
+as bytes or str. The output is compact UTF-8 JSON, so only the pieces
+are ever allocated, never the whole document.
+"""
+
+_ESCAPES = {
+    0x22: b'\\"',
+    0x5C: b'\\\\',
+    0x08: b'\\b',
+    0x09: b'\\t',
+    0x0A: b'\\n',
+    0x0C: b'\\f',
+    0x0D: b'\\r',
+}
+
+# short strings that need no escaping, already quoted, and keys with
+# their colon: the keys and state names repeat in every document, so
+# each is encoded and scanned only once
+_plain = {}
+_keys = {}
+PLAIN_MAX = 64
+
+
+def _escaped(s, write):
+    # write s quoted and escaped; -> whether it needed no escaping
+    data = s.encode()
+    write(b'"')
+    start = 0
+    for i in range(len(data)):
+        b = data[i]
+        if b < 0x20 or b == 0x22 or b == 0x5C:
+            if start < i:
+                write(memoryview(data)[start:i])
+            esc = _ESCAPES.get(b)
+            write(esc if esc is not None else '\\u%04x' % b)
+            start = i + 1
+    if start == 0:
+        write(data)
+    elif start < len(data):
+        write(memoryview(data)[start:])
+    write(b'"')
+    return start == 0
+
+
+def _string(s, write):
+    quoted = _plain.get(s)
+    if quoted is not None:
+        write(quoted)
+    elif _escaped(s, write) and len(s) <= 32 and len(_plain) < PLAIN_MAX:
+        _plain[s] = b'"' + s.encode() + b'"'
+
+
+def _key(k, write):
+    quoted = _keys.get(k)
+    if quoted is not None:
+        write(quoted)
+        return
+    if not isinstance(k, str):
+        k = str(k)
+    if _escaped(k, write) and len(_keys) < PLAIN_MAX:
+        _keys[k] = b'"' + k.encode() + b'":'
+    write(b':')
+
+
+def dump(obj, write):
+    if obj is None:
+        write(b'null')
+    elif obj is True:
+        write(b'true')
+    elif obj is False:
+        write(b'false')
+    elif isinstance(obj, str):
+        _string(obj, write)
+    elif isinstance(obj, (int, float)):
+        write(repr(obj))
+    elif isinstance(obj, dict):
+        write(b'{')
+        first = True
+        for k, v in obj.items():
+            if not first:
+                write(b',')
+            first = False
+            _key(k, write)
+            dump(v, write)
+        write(b'}')
+    elif isinstance(obj, (list, tuple)):
+        write(b'[')
+        first = True
+        for v in obj:
+            if not first:
+                write(b',')
+            first = False
+            dump(v, write)
+        write(b']')
+    else:
+        raise TypeError('cannot encode %r' % (obj,))
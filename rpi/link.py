@@ -0,0 +1,114 @@
+"""Keeps the cloud link up.
+
+When the link drops, recovery escalates with consecutive failures: the
+first attempts only reconnect MQTT, then the socket pool and TLS context
+are rebuilt as well, and after that Wi-Fi is rejoined too (straight
+away if the radio has lost its association). Attempts after a failure
+wait an exponentially growing, jittered delay. Each step is timed, and
+the timings of the last recovery are kept for the shadow report.
+
+(Not supervisor.py: CircuitPython's built-in supervisor module would be
+imported instead.)
+"""
+import random
+from asyncio import sleep, create_task
+
+from hal import wifi, ticks_ms, ticks_diff
+
+RECONNECT = 'reconnect'
+REBUILD = 'rebuild'
+REJOIN = 'rejoin'
+
+
+class LinkSupervisor:
+    # consecutive failures before rebuilding the pool, then rejoining
+    rebuild_after = 2
+    rejoin_after = 4
+    # backoff: base * 2**(failures - 1) seconds, capped, then jittered
+    # down to as little as half
+    base = 1.0
+    cap = 60.0
+
+    def __init__(self, iot):
+        self.disconnect = iot.disconnect
+        self.actions = {
+            REJOIN: iot.rejoin,
+            REBUILD: iot.rebuild,
+            RECONNECT: iot.start_mqtt,
+        }
+        self.state = 'offline'
+        self.failures = 0
+        self.drops = 0
+        # step -> ms it took, for the last recovery
+        self.steps = {}
+        self.recovery_ms = None
+        self.task = None
+
+    @property
+    def online(self):
+        return self.state == 'online'
+
+    def lost(self):
+        """Start recovering in the background, unless already."""
+        if self.online:
+            self.state = 'offline'
+            self.task = create_task(self.recover())
+
+    @property
+    def delay(self):
+        if not self.failures:
+            return 0
+        delay = min(self.cap, self.base * 2 ** (self.failures - 1))
+        return delay * (0.5 + random.random() / 2)
+
+    def escalation(self, cold=False):
+        if cold or self.failures >= self.rejoin_after \
+                or not wifi.radio.connected:
+            return (REJOIN, REBUILD, RECONNECT)
+        if self.failures >= self.rebuild_after:
+            return (REBUILD, RECONNECT)
+        return (RECONNECT,)
+
+    async def _step(self, name):
+        start = ticks_ms()
+        self.state = name
+        await self.actions[name]()
+        self.steps[name] = ticks_diff(ticks_ms(), start)
+        print('link:', name, 'took', self.steps[name], 'ms')
+
+    async def recover(self, cold=False):
+        """Bring the link back, retrying until it is up. `cold` starts
+        from nothing, as at boot."""
+        start = ticks_ms()
+        if not cold:
+            self.drops += 1
+        self.steps = {}
+        while True:
+            delay = self.delay
+            if delay:
+                self.state = 'backoff'
+                print('link: retrying in', delay, 's')
+                await sleep(delay)
+            self.disconnect()
+            try:
+                for name in self.escalation(cold):
+                    await self._step(name)
+            except Exception as error:
+                self.failures += 1
+                print('link:', self.state, 'failed:', error)
+                continue
+            break
+        self.failures = 0
+        self.state = 'online'
+        self.recovery_ms = ticks_diff(ticks_ms(), start)
+        print('link: up after', self.recovery_ms, 'ms')
+
+    @property
+    def summary(self):
+        return {
+            'state': self.state,
+            'drops': self.drops,
+            'failures': self.failures,
+            'recovery_ms': self.recovery_ms,
+            'steps': self.steps,
+        }
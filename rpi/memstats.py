@@ -0,0 +1,128 @@
+"""Heap instrumentation: what each task allocates, and how low it gets.
+
+Wrap a task's loop body in `start = mem.begin()` / `mem.end(name, start)`
+and use `mem.collect()` instead of gc.collect(). A body that awaits can
+wrap each synchronous part, ending all but the last with last=False, so
+other tasks' allocations are not charged to it. A drop in mem_alloc()
+since it was last read means the collector ran, so automatic collections
+are counted too, and the allocation of an iteration it ran in is left
+out. Every read also updates the low-water mark, so it catches the dips
+in the middle of a task's work, not just the level between them.
+"""
+from hal import gc
+
+
+class MemStats:
+    # samples between probes for the largest free block, and the most
+    # it looks for; see probe()
+    probe_every = 60
+    probe_max = 32768
+
+    def __init__(self):
+        # name -> [iterations, bytes allocated, most in one iteration,
+        #          bytes so far in the iteration in progress, or -1]
+        self.tasks = {}
+        self.free = gc.mem_free()
+        self.low_free = self.free
+        # heap size, so free memory follows from mem_alloc() alone
+        self.total = gc.mem_alloc() + self.free
+        self.largest_block = 0
+        self.collections = 0
+        self.samples = 0
+        # mem_alloc() when last read
+        self.alloc = gc.mem_alloc()
+
+    def _read(self):
+        # collections are counted here and in collect() only, so one seen
+        # by several iterations, or already counted, is not counted again
+        alloc = gc.mem_alloc()
+        if alloc < self.alloc:
+            self.collections += 1
+        self.alloc = alloc
+        free = self.total - alloc
+        if free < self.low_free:
+            # the simulator can allocate past its nominal heap
+            self.low_free = free if free > 0 else 0
+        return alloc
+
+    def begin(self):
+        return self._read()
+
+    def end(self, name, start, last=True):
+        delta = self._read() - start
+        task = self.tasks.get(name)
+        if task is None:
+            task = self.tasks[name] = [0, 0, 0, 0]
+        if delta < 0:
+            task[3] = -1
+        elif task[3] >= 0:
+            task[3] += delta
+        if not last:
+            return
+        task[0] += 1
+        delta, task[3] = task[3], 0
+        if delta < 0:
+            return
+        task[1] += delta
+        if delta > task[2]:
+            task[2] = delta
+
+    def collect(self):
+        gc.collect()
+        self.collections += 1
+        self.alloc = gc.mem_alloc()
+
+    def sample(self):
+        self.free = gc.mem_free()
+        if self.free < self.low_free:
+            self.low_free = self.free
+        if self.samples % self.probe_every == 0:
+            self.largest_block = self.probe()
+        self.samples += 1
+
+    def probe(self):
+        """The largest free block, to a power of two from 1 KB up to
+        `probe_max`, found by trying allocations of those sizes since
+        the heap can't be asked directly. A failed allocation makes
+        MicroPython collect first, so the sizes go up and stop at the
+        first failure: each probe costs at most one collection, plus up
+        to twice `probe_max` bytes of garbage."""
+        size, rv = 1024, 0
+        while size <= min(self.probe_max, self.free):
+            try:
+                block = bytearray(size)
+            except MemoryError:
+                break
+            del block
+            rv = size
+            size *= 2
+        return rv
+
+    def per_iteration(self, name):
+        n, total, worst, part = self.tasks.get(name, (0, 0, 0, 0))
+        return total // n if n else 0
+
+    @property
+    def summary(self):
+        return {
+            "free": self.free,
+            "low": self.low_free,
+            "block": self.largest_block,
+            "gcs": self.collections,
+            "tasks": {
+                name: [self.per_iteration(name), worst]
+                for name, (n, total, worst, part) in self.tasks.items()
+            },
+        }
+
+    @property
+    def top_task(self):
+        rv = None
+        for name in self.tasks:
+            if rv is None or self.per_iteration(name) > \
+                    self.per_iteration(rv):
+                rv = name
+        return rv
+
+
+mem = MemStats()
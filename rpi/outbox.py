@@ -0,0 +1,119 @@
+"""Shadow patches waiting to be published.
+
+Patches are coalesced as they are added, the latest value for each key
+winning, so however long the link was down the cloud gets one message
+with the net change. The outbox holds at most `limit` keys; past that
+it gives up on the patches and asks for a full resync instead.
+
+With `spill`, the pending patch is also kept in microcontroller.nvm,
+after the cycle history, so a reset while offline does not lose it.
+Flash wears, so it is written at most every `spill_interval` seconds.
+"""
+import json
+import struct
+import time
+
+from hal import microcontroller
+
+HEADER = '<4sH'
+HEADER_SIZE = struct.calcsize(HEADER)
+MAGIC = b'LMO1'
+
+
+def _leaves(v):
+    if isinstance(v, dict):
+        return sum(_leaves(x) for x in v.values())
+    return 1
+
+
+def _copy(v):
+    if isinstance(v, dict):
+        return {k: _copy(x) for k, x in v.items()}
+    return v
+
+
+def coalesce(pending, patch):
+    """Merge `patch` into `pending`, newer values winning; -> the change
+    in the number of leaf keys. Dicts are copied in: a patch may share
+    them with the shadow document, which must not see the merges."""
+    added = 0
+    for k, v in patch.items():
+        old = pending.get(k)
+        if isinstance(v, dict) and isinstance(old, dict):
+            added += coalesce(old, v)
+        else:
+            added += _leaves(v) - (_leaves(old) if k in pending else 0)
+            pending[k] = _copy(v)
+    return added
+
+
+class Outbox:
+    limit = 128
+    # where the spill lives in nvm, after the cycle history
+    offset = 1024
+    spill_interval = 60.0
+
+    def __init__(self, spill=False, nvm=None):
+        self.pending = {}
+        self.keys = 0
+        self.overflowed = False
+        self.spill = spill
+        self.nvm = microcontroller.nvm if nvm is None else nvm
+        self.dirty = False
+        self.spilled_at = -self.spill_interval
+        self.spills = 0
+        self.flushed = 0
+        if spill:
+            self.load()
+
+    def add(self, patch):
+        if self.overflowed or not patch:
+            return
+        self.keys += coalesce(self.pending, patch)
+        self.dirty = True
+        if self.keys > self.limit:
+            self.overflowed = True
+            self.pending = {}
+            self.keys = 0
+
+    def clear(self):
+        if self.pending:
+            self.flushed += 1
+        if self.spill and self.spills:
+            self.nvm[self.offset:self.offset + HEADER_SIZE] = \
+                struct.pack(HEADER, b'\0\0\0\0', 0)
+            self.spills = 0
+        self.pending = {}
+        self.keys = 0
+        self.overflowed = False
+        self.dirty = False
+
+    def save(self):
+        """Spill the pending patch to nvm, if it changed and the last
+        spill was long enough ago."""
+        now = time.monotonic()
+        if not (self.spill and self.dirty) or \
+                now - self.spilled_at < self.spill_interval:
+            return
+        data = json.dumps(self.pending).encode()
+        if self.offset + HEADER_SIZE + len(data) > len(self.nvm):
+            return
+        pos = self.offset + HEADER_SIZE
+        self.nvm[pos:pos + len(data)] = data
+        self.nvm[self.offset:pos] = struct.pack(HEADER, MAGIC, len(data))
+        self.dirty = False
+        self.spilled_at = now
+        self.spills += 1
+
+    def load(self):
+        magic, size = struct.unpack(
+            HEADER, bytes(self.nvm[self.offset:self.offset + HEADER_SIZE]))
+        if magic != MAGIC:
+            return
+        pos = self.offset + HEADER_SIZE
+        try:
+            self.add(json.loads(bytes(self.nvm[pos:pos + size])))
+        except ValueError:
+            return
+        self.spills = 1
+        print('Outbox: restored', self.keys, 'keys')
@@ -1,4 +1,4 @@
-import board
+from hal import board
 
 class Display:
     CLK = board.GP6
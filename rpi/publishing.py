@@ -0,0 +1,124 @@
+"""When shadow updates go out.
+
+Changes are debounced: an update waits until nothing has changed for
+`debounce` seconds, but no longer than `max_delay` after the first
+change, so a burst of UI actions becomes one message. A token bucket
+holds updates to `rate` an hour, in bursts of up to `burst`. Alarm
+transitions skip both, spending a token if there is one.
+"""
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        # tokens per second
+        self.rate = rate / 3600
+        self.burst = burst
+        self.tokens = burst
+        self.at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.at) * self.rate)
+        self.at = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self, now):
+        """Seconds until a token is there to take."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class PublishPolicy:
+    # seconds of quiet before an update goes out
+    debounce = 2.0
+    # ...unless the first change has waited this long
+    max_delay = 10.0
+    # updates an hour, and how many may go back to back
+    rate = 120
+    burst = 5
+
+    def __init__(self):
+        self.bucket = TokenBucket(self.rate, self.burst)
+        # when the first and latest unsent changes came
+        self.first = None
+        self.last = None
+        self.urgent = False
+        self.held = False
+        # changes folded into an update already waiting
+        self.merged = 0
+        # updates the rate limit held back
+        self.limited = 0
+        self.started = time.monotonic()
+        # kind of message -> [messages, bytes]
+        self.stats = {}
+
+    def changed(self, now, urgent=False):
+        if self.first is None:
+            self.first = now
+        else:
+            self.merged += 1
+        self.last = now
+        self.urgent = self.urgent or urgent
+
+    def wait(self, now):
+        """Seconds until the waiting update may go out, or None if
+        there is none."""
+        if self.first is None:
+            return None
+        if self.urgent:
+            return 0
+        quiet = min(self.last + self.debounce, self.first + self.max_delay)
+        return max(quiet - now, self.bucket.wait(now), 0)
+
+    def due(self, now):
+        if self.first is None:
+            return False
+        if self.urgent:
+            self.bucket.take(now)
+            return True
+        if now < min(self.last + self.debounce, self.first + self.max_delay):
+            return False
+        if self.bucket.take(now):
+            return True
+        if not self.held:
+            self.held = True
+            self.limited += 1
+        return False
+
+    def sent(self, kind, size):
+        stat = self.stats.setdefault(kind, [0, 0])
+        stat[0] += 1
+        stat[1] += size
+        if kind == 'shadow':
+            self.first = self.last = None
+            self.urgent = self.held = False
+
+    @property
+    def per_hour(self):
+        elapsed = time.monotonic() - self.started
+        if not elapsed:
+            return {}
+        return {
+            kind: {
+                'messages': int(messages * 3600 / elapsed),
+                'bytes': int(size * 3600 / elapsed),
+            }
+            for kind, (messages, size) in self.stats.items()
+        }
+
+    @property
+    def summary(self):
+        return {
+            'per_hour': self.per_hour,
+            'merged': self.merged,
+            'limited': self.limited,
+        }
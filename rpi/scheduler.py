@@ -0,0 +1,111 @@
+import time
+from asyncio import Event, TimeoutError, wait_for
+
+from memstats import mem
+
+
+def _push(heap, item):
+    heap.append(item)
+    i = len(heap) - 1
+    while i:
+        parent = (i - 1) >> 1
+        if heap[parent] <= item:
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = item
+
+
+def _pop(heap):
+    last = heap.pop()
+    if not heap:
+        return last
+    top = heap[0]
+    n = len(heap)
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= n:
+            break
+        if child + 1 < n and heap[child + 1] < heap[child]:
+            child += 1
+        if last <= heap[child]:
+            break
+        heap[i] = heap[child]
+        i = child
+    heap[i] = last
+    return top
+
+
+class Scheduler:
+    """Deadline timers on time.monotonic(), kept in a min-heap.
+
+    One task sleeps until the earliest deadline, so nothing has to poll.
+    Timers are [deadline, seq, callback, interval] lists; cancel() clears
+    the callback and the entry is dropped when it comes due.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.event = Event()
+        self.wakeups = 0
+        self.fired = 0
+        self.started = time.monotonic()
+
+    def call_at(self, deadline, callback, interval=None):
+        self.seq += 1
+        timer = [deadline, self.seq, callback, interval]
+        _push(self.heap, timer)
+        if self.heap[0] is timer:
+            # the sleeping task has to wake earlier than it planned
+            self.event.set()
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def call_every(self, interval, callback, delay=None):
+        return self.call_at(
+            time.monotonic() + (interval if delay is None else delay),
+            callback, interval
+        )
+
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None
+
+    @property
+    def wakeups_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.wakeups * 60 / elapsed if elapsed else 0
+
+    async def run(self):
+        while True:
+            start = mem.begin()
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                timer = _pop(self.heap)
+                callback, interval = timer[2], timer[3]
+                if callback is None:
+                    continue
+                if interval:
+                    timer[0] = max(timer[0] + interval, now)
+                    self.seq += 1
+                    timer[1] = self.seq
+                    _push(self.heap, timer)
+                self.fired += 1
+                callback()
+            mem.end('timers', start)
+
+            self.event.clear()
+            try:
+                if self.heap:
+                    await wait_for(
+                        self.event.wait(), self.heap[0][0] - time.monotonic()
+                    )
+                else:
+                    await self.event.wait()
+            except TimeoutError:
+                pass
+            self.wakeups += 1
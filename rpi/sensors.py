@@ -1,7 +1,13 @@
-import time
-import analogio
-import microcontroller
+import math
+from array import array
+from asyncio import sleep
+from collections import namedtuple
+from hal import (
+    analogio, microcontroller, open_uart, ticks_ms, ticks_us, ticks_add,
+    ticks_diff,
+)
 
+from memstats import mem
 from pins import Washer as WasherPins
 from pins import Dryer as DryerPins
 
@@ -23,10 +29,17 @@ from pins import Dryer as DryerPins
 
 class MaxValue:
     period = 2.0
+    # the deque only ever holds a non-increasing run of peaks, so this
+    # only has to cover the number of reads within one period
+    size = 128
     
-    def __init__(self, pin):
-        self.current = analogio.AnalogIn(pin)
-        self.history = []
+    def __init__(self):
+        # monotonic deque of (peak, ticks_ms) kept in a ring buffer
+        self.values = array('H', [0] * self.size)
+        self.times = array('L', [0] * self.size)
+        self.head = 0
+        self.count = 0
+        self.period_ms = int(self.period * 1000)
 
     #def analyze(self):
     #    l = []
@@ -41,40 +54,441 @@ class MaxValue:
     #    yr, yi = dft(l)
     #    syr = sorted([(v, i) for i, v in enumerate(yr[:len(l)//2])])
     #    print('syr[-4:]:', syr[-4:])
-        
+
+    def push(self, val, now):
+        size = self.size
+        # drop peaks that have aged out of the window
+        while self.count and ticks_diff(
+                now, self.times[self.head]
+        ) >= self.period_ms:
+            self.head = (self.head + 1) % size
+            self.count -= 1
+
+        # drop older peaks that the new value dominates
+        while self.count:
+            tail = (self.head + self.count - 1) % size
+            if self.values[tail] >= val:
+                break
+            self.count -= 1
+
+        if self.count == size:
+            self.head = (self.head + 1) % size
+            self.count -= 1
+
+        tail = (self.head + self.count) % size
+        self.values[tail] = val
+        self.times[tail] = now
+        self.count += 1
+
+    @property
+    def peak(self):
+        return self.values[self.head] if self.count else 0
+
+
+class Goertzel:
+    """Streaming single-bin DFT, for the flicker power at one frequency."""
+
+    def __init__(self, frequency, sample_rate, n):
+        self.n = n
+        self.coeff = 2 * math.cos(2 * math.pi * frequency / sample_rate)
+        self.reset()
+
+    def reset(self):
+        self.s1 = 0.0
+        self.s2 = 0.0
+
+    def update(self, x):
+        s = x + self.coeff * self.s1 - self.s2
+        self.s2 = self.s1
+        self.s1 = s
+
+    @property
+    def power(self):
+        s1, s2 = self.s1, self.s2
+        return s1 * s1 + s2 * s2 - self.coeff * s1 * s2
+
     @property
-    def value(self):
-        # after some analysis, I think that the light frequency is 250 Hz
-        val = self.current.value
-        for i in range(9):
-            microcontroller.delay_us(1100)
-            val = max(val, self.current.value)
-            
-        now = time.monotonic()
-        oldest = now - self.period
-        rv = val
-        new_history = []
-        for i in self.history:
-            v, t = i
-            if t > oldest and v >= val:
-                new_history.append(i)
-                rv = max(rv, v)
-                
-        new_history.append((val, now))
-        self.history = new_history
+    def amplitude(self):
+        return int(2 * math.sqrt(max(self.power, 0)) / self.n)
+
+
+# windowed levels of every washer channel, as of `time` (ticks_ms)
+Snapshot = namedtuple(
+    'Snapshot', ['time', 'cycle_complete', 'blank', 'lid_locked']
+)
+
+
+class Sampler:
+    interval = 0.5
+    # after some analysis, I think that the light frequency is 250 Hz,
+    # so a burst of 10 samples 1.1 ms apart covers a couple of periods
+    frequency = 250
+    samples = 10
+    spacing_us = 1100
+    # take the bursts across many short slices rather than blocking
+    cooperative = True
+    # added to the blank level before comparing, see Washer
+    floor = 0
+
+    def __init__(self, detector='peak'):
+        # 'peak' tracks the max of each burst; 'goertzel' tracks the
+        # amplitude of the flicker itself, which ignores steady light
+        self.detector = detector
+        self.filters = None
+        if detector == 'goertzel':
+            # 20 samples at 1 kHz puts 250 Hz exactly on bin 5. The
+            # filter needs evenly spaced samples, so don't yield mid-burst
+            self.samples = 20
+            self.spacing_us = 1000
+            self.cooperative = False
+            self.floor = 200
+            self.filters = tuple(
+                Goertzel(self.frequency, 1_000_000 / self.spacing_us,
+                         self.samples)
+                for i in range(3)
+            )
+        self.cycle_complete = analogio.AnalogIn(WasherPins.CYCLE_COMPLETE)
+        self.blank = analogio.AnalogIn(WasherPins.BLANK)
+        self.lid_locked = analogio.AnalogIn(WasherPins.LID_LOCKED)
+        self.cycle_complete_buf = array('H', [0] * self.samples)
+        self.blank_buf = array('H', [0] * self.samples)
+        self.lid_locked_buf = array('H', [0] * self.samples)
+        self.cycle_complete_max = MaxValue()
+        self.blank_max = MaxValue()
+        self.lid_locked_max = MaxValue()
+        self.snapshot = Snapshot(ticks_ms(), 0, 0, 0)
+        # a trace.TraceWriter, to record every burst
+        self.recorder = None
+        # a telemetry.Telemetry, to downsample every burst level
+        self.telemetry = None
+        self.taken = 0
+
+    def _read(self, i):
+        # round-robin, so every channel sees the same moment of the flicker
+        self._store(
+            i, self.cycle_complete.value, self.blank.value,
+            self.lid_locked.value
+        )
+
+    def _store(self, i, cycle_complete, blank, lid_locked):
+        self.cycle_complete_buf[i] = cycle_complete
+        self.blank_buf[i] = blank
+        self.lid_locked_buf[i] = lid_locked
+        if self.filters:
+            self.filters[0].update(cycle_complete)
+            self.filters[1].update(blank)
+            self.filters[2].update(lid_locked)
+
+    def replay(self, now, cycle_complete, blank, lid_locked):
+        """Run one recorded burst through the detector."""
+        if len(cycle_complete) != self.samples:
+            raise ValueError(
+                f'trace has {len(cycle_complete)} samples per burst, '
+                f'the {self.detector} detector takes {self.samples}'
+            )
+        for i in range(self.samples):
+            self._store(i, cycle_complete[i], blank[i], lid_locked[i])
+        return self._update(now)
+
+    def _levels(self):
+        if self.filters:
+            rv = tuple(f.amplitude for f in self.filters)
+            for f in self.filters:
+                f.reset()
+            return rv
+        return (
+            max(self.cycle_complete_buf),
+            max(self.blank_buf),
+            max(self.lid_locked_buf),
+        )
+
+    def sample(self):
+        # on the same schedule as sample_async(), so the time the reads
+        # and filter updates take doesn't stretch the spacing the
+        # Goertzel coefficients were computed for
+        now = ticks_ms()
+        due = ticks_us()
+        self._read(0)
+        for i in range(1, self.samples):
+            due = ticks_add(due, self.spacing_us)
+            wait = ticks_diff(due, ticks_us())
+            if wait > 0:
+                microcontroller.delay_us(wait)
+            self._read(i)
+        return self._update(now)
+
+    async def sample_async(self):
+        # each gap is its own slice so other tasks run between samples;
+        # only the slices are charged to the sampler. Samples are due
+        # every spacing_us from the first, so time other tasks take comes
+        # out of the delay; a sample already late is taken at once
+        start = mem.begin()
+        now = ticks_ms()
+        due = ticks_us()
+        self._read(0)
+        for i in range(1, self.samples):
+            mem.end('sampler', start, last=False)
+            await sleep(0)
+            start = mem.begin()
+            due = ticks_add(due, self.spacing_us)
+            wait = ticks_diff(due, ticks_us())
+            if wait > 0:
+                microcontroller.delay_us(wait)
+            self._read(i)
+        rv = self._update(now)
+        mem.end('sampler', start)
         return rv
 
+    def _update(self, now):
+        self.taken += 1
+        if self.recorder:
+            self.recorder.write(
+                now, self.spacing_us, self.cycle_complete_buf,
+                self.blank_buf, self.lid_locked_buf
+            )
+        cycle_complete, blank, lid_locked = self._levels()
+        if self.telemetry:
+            self.telemetry.add(now, cycle_complete, blank, lid_locked)
+        self.cycle_complete_max.push(cycle_complete, now)
+        self.blank_max.push(blank, now)
+        self.lid_locked_max.push(lid_locked, now)
+        self.snapshot = Snapshot(
+            now,
+            self.cycle_complete_max.peak,
+            self.blank_max.peak,
+            self.lid_locked_max.peak,
+        )
+        return self.snapshot
+
+    async def run(self):
+        while True:
+            if self.cooperative:
+                await self.sample_async()
+            else:
+                start = mem.begin()
+                self.sample()
+                mem.end('sampler', start)
+            await sleep(self.interval)
+
+
+class Hysteresis:
+    """A level compared against a reference, with separate enter and
+    exit multipliers, that has to stay across the threshold for `dwell`
+    seconds before the output flips."""
+
+    def __init__(self, enter, exit, dwell):
+        self.enter = enter
+        self.exit = exit
+        self.dwell_ms = int(dwell * 1000)
+        self.value = False
+        self.pending_since = None
+        # crossings that reverted before the dwell time was up
+        self.suppressed = 0
+
+    def update(self, level, reference, floor, now):
+        if self.value:
+            crossed = level <= reference * self.exit + floor
+        else:
+            crossed = level > reference * self.enter + floor
+
+        if not crossed:
+            if self.pending_since is not None:
+                self.suppressed += 1
+                self.pending_since = None
+        elif self.pending_since is None:
+            self.pending_since = now
+        elif ticks_diff(now, self.pending_since) >= self.dwell_ms:
+            self.value = not self.value
+            self.pending_since = None
+        return self.value
+
 
 class Washer:
-    def __init__(self):
-        self.cycle_complete_raw = MaxValue(WasherPins.CYCLE_COMPLETE)
-        self.blank_raw = MaxValue(WasherPins.BLANK)
-        self.lid_locked_raw = MaxValue(WasherPins.LID_LOCKED)
+    # (enter, exit) multiples of the blank level
+    cycle_complete_thresholds = (1.7, 1.4)
+    lid_locked_thresholds = (4, 3)
+    # seconds a crossing has to hold before the state machine sees it
+    dwell = 3.0
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.cycle_complete_filter = Hysteresis(
+            *self.cycle_complete_thresholds, self.dwell
+        )
+        self.lid_locked_filter = Hysteresis(
+            *self.lid_locked_thresholds, self.dwell
+        )
+        self.last_snapshot = None
+
+    def restore(self, washer_state):
+        # start the filters where the state machine left off, so it does
+        # not move on from a restored state before real samples say so
+        self.cycle_complete_filter.value = washer_state == 'Done'
+        self.lid_locked_filter.value = washer_state == 'Running'
+
+    def _refresh(self):
+        s = self.sampler.snapshot
+        # the snapshot before the first burst is only a placeholder
+        if s is self.last_snapshot or not self.sampler.taken:
+            return
+        self.last_snapshot = s
+        floor = self.sampler.floor
+        self.cycle_complete_filter.update(
+            s.cycle_complete, s.blank, floor, s.time
+        )
+        self.lid_locked_filter.update(s.lid_locked, s.blank, floor, s.time)
 
     @property
     def cycle_complete(self):
-        return self.cycle_complete_raw.value > (self.blank_raw.value * 1.7)
+        self._refresh()
+        return self.cycle_complete_filter.value
 
     @property
     def lid_locked(self):
-        return self.lid_locked_raw.value > (self.blank_raw.value * 4)
+        self._refresh()
+        return self.lid_locked_filter.value
+
+    @property
+    def suppressed(self):
+        return {
+            "cycle_complete": self.cycle_complete_filter.suppressed,
+            "lid_locked": self.lid_locked_filter.suppressed,
+        }
+
+
+class SamplingPolicy:
+    """Picks the sampler interval from the state of the washer: rarely
+    while it sits idle, often once the lid lock starts to rise or a
+    cycle is near its end. Once it is Done the LED can stay lit for hours
+    until the washer is unloaded, and only going back to Idle is left to
+    see, so that takes the running rate."""
+    # seconds between samples in each tier
+    tiers = {
+        'idle': 5.0,
+        'running': 2.0,
+        'active': 0.5,
+    }
+    # the lid lock counts as rising above this multiple of the blank level
+    rising = 2.0
+    # a running cycle counts as near its end after this many seconds
+    ending_after = 25 * 60
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.tier = 'active'
+        # washer state -> [samples taken, seconds spent]
+        self.stats = {}
+        self.last = None
+
+    def update(self, washer_state, elapsed, now):
+        if self.last:
+            last_state, last_now, last_taken = self.last
+            stat = self.stats.setdefault(last_state, [0, 0.0])
+            stat[0] += self.sampler.taken - last_taken
+            stat[1] += now - last_now
+        self.last = (washer_state, now, self.sampler.taken)
+
+        s = self.sampler.snapshot
+        rising = s.lid_locked > s.blank * self.rising + self.sampler.floor
+        if washer_state == 'Running':
+            if elapsed is not None and elapsed >= self.ending_after:
+                self.tier = 'active'
+            else:
+                self.tier = 'running'
+        elif washer_state == 'Done':
+            self.tier = 'running'
+        elif washer_state == 'Idle' and not rising:
+            self.tier = 'idle'
+        else:
+            self.tier = 'active'
+        self.sampler.interval = self.tiers[self.tier]
+
+    @property
+    def per_hour(self):
+        return {
+            state: int(samples * 3600 / seconds)
+            for state, (samples, seconds) in self.stats.items()
+            if seconds
+        }
+
+
+class Dryer:
+    """Dryer status, read from frames on the dryer UART.
+
+    A frame is STX (0x02), a payload length, the payload, and the XOR of
+    the length and payload bytes. The payload is a status byte (an index
+    into STATES) and the remaining time in seconds as a big-endian uint16.
+    """
+    STATES = ('Idle', 'Running', 'Done')
+    STX = 0x02
+    MAX_PAYLOAD = 16
+    size = 64
+    baudrate = 9600
+
+    def __init__(self, stream=None):
+        if stream is None:
+            # the pins are named from the dryer's side
+            stream = open_uart(DryerPins.RXD, DryerPins.TXD, self.baudrate)
+        self.stream = stream
+        self.buf = bytearray(self.size)
+        self.mv = memoryview(self.buf)
+        self.head = 0
+        self.count = 0
+        self.state = None
+        self.remaining = 0
+        self.updated = None
+        self.frames = 0
+        self.errors = 0
+
+    def _at(self, i):
+        return self.buf[(self.head + i) % self.size]
+
+    def _drop(self, n):
+        self.head = (self.head + n) % self.size
+        self.count -= n
+
+    def parse(self):
+        while self.count >= 4:
+            n = self._at(1)
+            if self._at(0) != self.STX or not 0 < n <= self.MAX_PAYLOAD:
+                # resync on the next byte
+                self._drop(1)
+                self.errors += 1
+                continue
+            if self.count < n + 3:
+                return
+            chk = n
+            for i in range(2, n + 2):
+                chk ^= self._at(i)
+            if chk != self._at(n + 2):
+                self._drop(1)
+                self.errors += 1
+                continue
+
+            status = self._at(2)
+            if status < len(self.STATES):
+                self.state = self.STATES[status]
+                self.remaining = (
+                    self._at(3) << 8 | self._at(4) if n >= 3 else 0
+                )
+                self.updated = ticks_ms()
+                self.frames += 1
+            else:
+                self.errors += 1
+            self._drop(n + 3)
+
+    async def run(self):
+        while True:
+            if self.count == self.size:
+                # no frame fits in a full buffer, so it is all noise
+                self._drop(self.size)
+                self.errors += 1
+            # read into the contiguous free space after the tail
+            tail = (self.head + self.count) % self.size
+            end = self.size if tail >= self.head else self.head
+            n = await self.stream.readinto(self.mv[tail:end])
+            start = mem.begin()
+            if n:
+                self.count += n
+                self.parse()
+            mem.end('dryer', start)
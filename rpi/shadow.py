@@ -0,0 +1,58 @@
+def merge(doc, new, prune=True, deep=None):
+    """Update `doc` in place to match `new`, and return the AWS shadow
+    patch that does the same: changed and added keys with their values,
+    removed keys as None (null deletes a key from a shadow). Without
+    `prune`, `new` is taken to be partial and nothing is removed. `deep`
+    is `prune` for the levels below, if different."""
+    if deep is None:
+        deep = prune
+    patch = {}
+    for k, v in new.items():
+        old = doc.get(k)
+        if isinstance(v, dict) and isinstance(old, dict):
+            sub = merge(old, v, deep)
+            if sub:
+                patch[k] = sub
+        elif k not in doc or old != v:
+            doc[k] = v
+            patch[k] = v
+    if prune:
+        for k in [k for k in doc if k not in new]:
+            del doc[k]
+            patch[k] = None
+    return patch
+
+
+def partial(obj, fields):
+    """The part of `obj.reported` for the marked `fields`, built from
+    just those: each goes where `obj.report_paths` says, with the value
+    from `obj.report_value(field)`. Fields not reported are skipped."""
+    rv = {}
+    for field in fields:
+        path = obj.report_paths.get(field)
+        if path is None:
+            continue
+        d = rv
+        for key in path[:-1]:
+            d = d.setdefault(key, {})
+        d[path[-1]] = obj.report_value(field)
+    return rv
+
+
+class Shadow:
+    """The reported document as last sent, kept up to date in place.
+
+    update() takes only the sections that may have changed, so the cost
+    of a publish follows what changed rather than the whole document.
+    With `prune` off the sections may be partial, as from partial().
+    """
+
+    def __init__(self):
+        self.doc = {}
+
+    def update(self, sections, prune=True):
+        # sections left out are unchanged, not removed
+        return merge(self.doc, sections, prune=False, deep=prune)
+
+    def clear(self):
+        self.doc = {}
@@ -1,8 +1,16 @@
-import gc
 import time
-from asyncio import sleep, gather
+from asyncio import gather
+from os import getenv
 
 import sensors
+from changes import ChangeMixin, latest_version
+from hal import ticks_ms
+from history import History, WASHER, DRYER, MANUAL
+from journal import Journal
+from memstats import mem
+from scheduler import Scheduler
+from telemetry import Telemetry
+from trace import TraceWriter
 
 
 def duration_str(s):
@@ -18,28 +26,34 @@ def duration_str(s):
     return rv
 
 
-class ChangeMixin:
-    @property
-    def changed(self):
-        v = getattr(self, '_changed', False)
-        self._changed = False
-        return v
-
-    @changed.setter
-    def changed(self, value):
-        self._changed = value
-
-
 class AutoState(ChangeMixin):
-    def __init__(self, alarm):
+    report_paths = {
+        'washer_state': ('washer', 'state'),
+        'washer_started': ('washer', 'washer_started'),
+        'washer_finished': ('washer', 'washer_finished'),
+        'dryer_state': ('dryer', 'state'),
+    }
+
+    def __init__(self, alarm, scheduler=None, detector='peak', history=None):
         self.alarm = alarm
-        self.washer = sensors.Washer()
+        self.scheduler = scheduler
+        self.history = history
+        self.sampler = sensors.Sampler(detector)
+        self.washer = sensors.Washer(self.sampler)
+        self.sampling = sensors.SamplingPolicy(self.sampler)
+        self.telemetry = self.sampler.telemetry = Telemetry()
         self.washer_state = 'Idle'
         self.washer_started = None
         self.washer_finished = None
+        self.dryer = sensors.Dryer()
+        self.dryer_state = 'Idle'
+        self.dryer_started = None
+        if scheduler:
+            scheduler.call_later(0, self._tick)
 
     @property
     def reported(self):
+        snapshot = self.sampler.snapshot
         return {
             "washer": { 
                 "state": self.washer_state,
@@ -48,42 +62,102 @@ class AutoState(ChangeMixin):
                 "lid_locked": self.washer.lid_locked,
                 "cycle_complete": self.washer.cycle_complete,
                 "raw": {
-                    "lid_locked": self.washer.lid_locked_raw.value,
-                    "cycle_complete": self.washer.cycle_complete_raw.value,
-                    "blank": self.washer.blank_raw.value,
-                }
-            }
+                    "lid_locked": snapshot.lid_locked,
+                    "cycle_complete": snapshot.cycle_complete,
+                    "blank": snapshot.blank,
+                },
+                "suppressed": self.washer.suppressed,
+                "sampling": {
+                    "tier": self.sampling.tier,
+                    "per_hour": self.sampling.per_hour,
+                },
+            },
+            "dryer": {
+                "state": self.dryer_state,
+                "remaining": self.dryer.remaining,
+            },
         }
 
-    async def update(self):
-        while True:
-            if self.washer_state == 'Idle' and self.washer.lid_locked:
-                self.washer_state = 'Running'
-                self.washer_started = time.monotonic()
-                self.changed = True
-
-            if all((
-                self.washer_state == 'Running',
-                self.washer.cycle_complete,
-                not self.washer.lid_locked,
-            )):
-                self.washer_state = 'Done'
-                self.washer_finished = time.monotonic()
-                self.changed = True
-                self.alarm.alarm('Washer cycle complete')
-
-            # it really shouldn't go idle until the dryer starts, but...
-            if all((
-                self.washer_state == 'Done',
-                not self.washer.cycle_complete,
-                not self.washer.lid_locked,
-            )):
-                self.washer_state = 'Idle'
-                self.washer_started = None
-                self.washer_finished = None
-                self.changed = True
-                
-            await sleep(1.0)
+    def step(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        if self.washer_state == 'Idle' and self.washer.lid_locked:
+            self.washer_state = 'Running'
+            self.washer_started = now
+            self.mark('washer_state', 'washer_started')
+
+        if all((
+            self.washer_state == 'Running',
+            self.washer.cycle_complete,
+            not self.washer.lid_locked,
+        )):
+            self.washer_state = 'Done'
+            self.washer_finished = now
+            self.mark('washer_state', 'washer_finished')
+            if self.history:
+                self.history.add(WASHER, self.washer_started, now)
+            self.alarm.alarm('Washer cycle complete')
+
+        # it really shouldn't go idle until the dryer starts, but...
+        if self.washer_state == 'Done' and (
+                self.dryer_state == 'Running' or (
+                    not self.washer.cycle_complete
+                    and not self.washer.lid_locked
+                )
+        ):
+            self.washer_state = 'Idle'
+            self.washer_started = None
+            self.washer_finished = None
+            self.mark('washer_state', 'washer_started', 'washer_finished')
+
+        dryer_state = self.dryer.state
+        if dryer_state and dryer_state != self.dryer_state:
+            self.dryer_state = dryer_state
+            self.mark('dryer_state')
+            if dryer_state == 'Running':
+                self.dryer_started = now
+            if dryer_state == 'Done':
+                self.alarm.alarm('Dryer cycle complete')
+                if self.history and self.dryer_started is not None:
+                    self.history.add(DRYER, self.dryer_started, now)
+                self.dryer_started = None
+
+        self.sampling.update(
+            self.washer_state,
+            now - self.washer_started if self.washer_started else None,
+            now,
+        )
+
+    def restore(self, washer_state, started, finished, dryer_state):
+        self.washer_state = washer_state
+        self.washer_started = started
+        self.washer_finished = finished
+        self.dryer_state = dryer_state
+        self.washer.restore(washer_state)
+
+    def _tick(self):
+        self.step()
+        # no point in checking more often than the sensors change
+        self.scheduler.call_later(max(1.0, self.sampler.interval), self._tick)
+
+    @property
+    def dryer_remaining(self):
+        if self.dryer_state != 'Running':
+            return ''
+        return duration_str(self.dryer.remaining)
+
+    @property
+    def washer_remaining(self):
+        """Estimated time left in the running cycle, from the history."""
+        if self.washer_state != 'Running' or not self.history:
+            return ''
+        remaining = self.history.remaining(
+            WASHER, time.monotonic() - self.washer_started
+        )
+        if remaining is None:
+            return ''
+        return duration_str(remaining)
 
     @property
     def washer_elapsed(self):
@@ -99,14 +173,23 @@ class AutoState(ChangeMixin):
             
 
 class ManualState(ChangeMixin):
-    def __init__(self, alarm):
+    report_paths = {
+        'washer_state': ('washer', 'state'),
+        'dryer_state': ('dryer', 'state'),
+    }
+
+    def __init__(self, alarm, scheduler, history=None):
         self.alarm = alarm
+        self.scheduler = scheduler
+        self.history = history
         self.washer_state = 'Idle'
         self.dryer_state = 'Idle'
         self.washer_runtime = 60 * 60
         self.dryer_runtime = 60 * 60
         self.washer_timeout = 0
         self.dryer_timeout = 0
+        self.washer_timer = None
+        self.dryer_timer = None
 
     @property
     def reported(self):
@@ -119,25 +202,76 @@ class ManualState(ChangeMixin):
             }
         }
         
+    def restore(self, washer_state, washer_timeout, dryer_state,
+                dryer_timeout):
+        self.washer_state = washer_state
+        self.dryer_state = dryer_state
+        if washer_timeout:
+            self.washer_timeout = washer_timeout
+            self.washer_timer = self.scheduler.call_at(
+                washer_timeout, self.washer_done
+            )
+        if dryer_timeout:
+            self.dryer_timeout = dryer_timeout
+            self.dryer_timer = self.scheduler.call_at(
+                dryer_timeout, self.dryer_done
+            )
+
     def start_washer(self):
         self.washer_state = 'Running'
         self.washer_timeout = time.monotonic() + self.washer_runtime
-        self.changed = True
+        self.scheduler.cancel(self.washer_timer)
+        self.washer_timer = self.scheduler.call_at(
+            self.washer_timeout, self.washer_done
+        )
+        self.mark('washer_state')
 
     def reset_washer(self):
         self.washer_state = 'Idle'
         self.washer_timeout = 0
-        self.changed = True
+        self.scheduler.cancel(self.washer_timer)
+        self.washer_timer = None
+        self.mark('washer_state')
+
+    def washer_done(self):
+        if self.history:
+            self.history.add(
+                MANUAL, self.washer_timeout - self.washer_runtime,
+                self.washer_timeout
+            )
+        self.washer_state = 'Done'
+        self.washer_timeout = 0
+        self.washer_timer = None
+        self.mark('washer_state')
+        self.alarm.alarm('Washer timer done')
 
     def start_dryer(self):
         self.dryer_state = 'Running'
         self.dryer_timeout = time.monotonic() + self.dryer_runtime
-        self.changed = True
+        self.scheduler.cancel(self.dryer_timer)
+        self.dryer_timer = self.scheduler.call_at(
+            self.dryer_timeout, self.dryer_done
+        )
+        self.mark('dryer_state')
 
     def reset_dryer(self):
         self.dryer_state = 'Idle'
         self.dryer_timeout = 0
-        self.changed = True
+        self.scheduler.cancel(self.dryer_timer)
+        self.dryer_timer = None
+        self.mark('dryer_state')
+
+    def dryer_done(self):
+        if self.history:
+            self.history.add(
+                MANUAL | DRYER, self.dryer_timeout - self.dryer_runtime,
+                self.dryer_timeout
+            )
+        self.dryer_state = 'Done'
+        self.dryer_timeout = 0
+        self.dryer_timer = None
+        self.mark('dryer_state')
+        self.alarm.alarm('Dryer timer done')
 
     @property
     def washer_remaining(self):
@@ -150,55 +284,73 @@ class ManualState(ChangeMixin):
         if self.dryer_timeout == 0:
             return ''
         return duration_str(self.dryer_timeout - time.monotonic())
-    
-    async def update(self):
-        while True:
-            if self.washer_timeout and time.monotonic() > self.washer_timeout:
-                self.washer_state = 'Done'
-                self.washer_timeout = 0
-                self.changed = True
-                self.alarm.alarm('Washer timer done')
-
-            if self.dryer_timeout and time.monotonic() > self.dryer_timeout:
-                self.dryer_state = 'Done'
-                self.dryer_timeout = 0
-                self.changed = True
-                self.alarm.alarm('Dryer timer done')
-                
-            await sleep(1.0)
 
 
 class AlarmState(ChangeMixin):
-    def __init__(self):
+    report_paths = {
+        'state': ('state',),
+        'messages': ('messages',),
+        'snooze_until': ('snooze_until',),
+    }
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
         self.state = 'Idle'
         self.messages = set()
         self.snooze_until = None
+        self.snooze_timer = None
+
+    def _cancel_snooze(self):
+        if self.scheduler:
+            self.scheduler.cancel(self.snooze_timer)
+        self.snooze_timer = None
+        self.snooze_until = None
+
+    def restore(self, state, messages, snooze_until):
+        self.state = state
+        self.messages = messages
+        if state == 'Snooze' and snooze_until is not None:
+            self.snooze_until = snooze_until
+            if self.scheduler:
+                self.snooze_timer = self.scheduler.call_at(
+                    snooze_until, self.alarm
+                )
 
     def alarm(self, message=None):
         self.state = 'Alarm'
         if message:
             self.messages.add(message)
-        self.snooze_until = None
-        self.changed = True
+        self._cancel_snooze()
+        self.mark('state', 'messages', 'snooze_until')
 
     def snooze(self, duration=30 * 60):
         if self.state != 'Alarm':
             return
         self.state = 'Snooze'
         self.snooze_until = time.monotonic() + duration
-        self.changed = True
+        if self.scheduler:
+            self.snooze_timer = self.scheduler.call_at(
+                self.snooze_until, self.alarm
+            )
+        self.mark('state', 'snooze_until')
 
     def cancel(self):
         self.state = 'Idle'
         self.messages = set()
-        self.changed = True
+        self._cancel_snooze()
+        self.mark('state', 'messages', 'snooze_until')
+
+    def report_value(self, field):
+        if field == 'messages':
+            return sorted(list(self.messages))
+        return getattr(self, field)
 
     @property
     def reported(self):
         return {
             "state": self.state,
             "snooze_until": self.snooze_until,
-            "messages": sorted(list(self.messages)),
+            "messages": self.report_value('messages'),
         }
 
     @property
@@ -208,7 +360,7 @@ class AlarmState(ChangeMixin):
     def handle_delta(self, desired):
         if 'messages' in desired:
             self.messages = set(desired['messages'])
-            self.changed = True
+            self.mark('messages')
             
         if 'state' in desired:
             if desired['state'] == 'Idle':
@@ -219,28 +371,42 @@ class AlarmState(ChangeMixin):
                 if 'snooze_until' in desired:
                     duration = desired['snooze_until'] - time.monotonic()
                 self.snooze(duration)
-    
-    async def update(self):
-        while True:
-            if (
-                    self.state == 'Snooze' and self.snooze_until
-                    and time.monotonic() > self.snooze_until
-            ):
-                self.state = 'Alarm'
-                self.snooze_until = None
-                
-            await sleep(5.0)
 
             
 class State(ChangeMixin):
     def __init__(self):
-        self.alarm_state = AlarmState()
-        self.auto_state = AutoState(self.alarm_state)
-        self.manual_state = ManualState(self.alarm_state)
+        self.scheduler = Scheduler()
+        self.history = History()
+        self.alarm_state = AlarmState(self.scheduler)
+        self.auto_state = AutoState(
+            self.alarm_state, self.scheduler, history=self.history
+        )
+        self.manual_state = ManualState(
+            self.alarm_state, self.scheduler, self.history
+        )
         self.mode = 'Auto'
-        self.max_free_mem = gc.mem_free()
-        self.max_free_mem_time = time.monotonic()
+        # with TRACE_PATH set, every washer burst is recorded there for
+        # hal.sim.replay; the filesystem has to be writable (see boot.py)
+        self.recorder = None
+        if getenv('TRACE_PATH'):
+            self.recorder = TraceWriter(getenv('TRACE_PATH'))
+            self.auto_state.sampler.recorder = self.recorder
+        self.scheduler.call_every(5.0, mem.sample, delay=0)
         self.last_tickle = time.monotonic()
+        # pick up where we were before the last reset
+        self.journal = Journal(self)
+        self.journal.restore()
+        self.scheduler.call_every(self.journal.interval, self.journal.save)
+
+    @property
+    def busy(self):
+        return (
+            self.auto_state.washer_state == 'Running'
+            or self.auto_state.dryer_state == 'Running'
+            or self.manual_state.washer_state == 'Running'
+            or self.manual_state.dryer_state == 'Running'
+            or self.alarm_state.state == 'Snooze'
+        )
 
     @property
     def awake(self):
@@ -262,33 +428,49 @@ class State(ChangeMixin):
     def tickle(self):
         self.last_tickle = time.monotonic()
 
+    def annotate(self, event):
+        """Mark a trace.EVENTS event, seen by eye, in the trace being
+        recorded: these marks are the ground truth replay measures the
+        detector against. From the REPL, or the Stats page."""
+        if self.recorder:
+            self.recorder.mark(ticks_ms(), event)
+            self.recorder.flush()
+
     def set_mode(self, mode):
         self.mode = mode
-        self.changed = True
+        self.mark('mode')
         
-    def should_report_now(self):
-        return any([
-            self.changed,
-            self.alarm_state.changed,
-            self.auto_state.changed,
-            self.manual_state.changed,
-        ])
-        
-    async def local_update(self):
-        while True:
-            if time.monotonic() > self.max_free_mem_time + 5:
-                self.max_free_mem = gc.mem_free()
-                self.max_free_mem_time = time.monotonic()
-            else:
-                self.max_free_mem = max(self.max_free_mem, gc.mem_free())
-
-            await sleep(0.1)
+    @property
+    def latest_version(self):
+        return latest_version()
+
+    def changes_since(self, version):
+        """Changed fields per section, e.g. {'alarm': {'state'}}."""
+        rv = {}
+        for section, obj in (
+                ('state', self),
+                ('alarm', self.alarm_state),
+                ('auto', self.auto_state),
+                ('manual', self.manual_state),
+                ('history', self.history),
+        ):
+            if obj.version > version:
+                rv[section] = obj.changed_since(version)
+        return rv
+
+    def should_report_now(self, version):
+        return any(
+            obj.version > version for obj in (
+                self, self.alarm_state, self.auto_state, self.manual_state,
+                self.history,
+            )
+        )
         
     async def update(self):
         await gather(
-            self.local_update(),
-            self.manual_state.update(),
-            self.auto_state.update()
+            self.scheduler.run(),
+            self.auto_state.sampler.run(),
+            self.auto_state.dryer.run(),
         )
 
     def handle_delta(self, msg):
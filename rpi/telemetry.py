@@ -0,0 +1,93 @@
+"""Raw washer sensor levels, downsampled into fixed-size buckets.
+
+Every burst level is folded into the current bucket's min/max/sum/count
+per channel, all held in preallocated arrays. Completed buckets wait
+until IOT drains them into one batched message.
+"""
+from array import array
+
+from hal import ticks_ms, ticks_diff
+
+CHANNELS = ('cycle_complete', 'blank', 'lid_locked')
+
+
+class Telemetry:
+    bucket_seconds = 10
+    # completed buckets kept for upload; older ones are dropped
+    size = 12
+
+    def __init__(self):
+        n = (self.size + 1) * len(CHANNELS)
+        self.mins = array('H', [0] * n)
+        self.maxs = array('H', [0] * n)
+        self.sums = array('L', [0] * n)
+        self.counts = array('H', [0] * (self.size + 1))
+        self.starts = array('L', [0] * (self.size + 1))
+        self.bucket_ms = self.bucket_seconds * 1000
+        # the bucket being filled, and how many completed ones precede it
+        self.head = 0
+        self.pending = 0
+        self.dropped = 0
+        self._open(ticks_ms())
+
+    def _open(self, now):
+        self.starts[self.head] = now
+        self.counts[self.head] = 0
+        base = self.head * len(CHANNELS)
+        for c in range(len(CHANNELS)):
+            self.mins[base + c] = 0xFFFF
+            self.maxs[base + c] = 0
+            self.sums[base + c] = 0
+
+    def add(self, now, cycle_complete, blank, lid_locked):
+        if ticks_diff(now, self.starts[self.head]) >= self.bucket_ms:
+            if self.counts[self.head]:
+                if self.pending == self.size:
+                    self.dropped += 1
+                else:
+                    self.pending += 1
+                self.head = (self.head + 1) % (self.size + 1)
+            self._open(now)
+
+        self.counts[self.head] += 1
+        base = self.head * len(CHANNELS)
+        self._fold(base, cycle_complete)
+        self._fold(base + 1, blank)
+        self._fold(base + 2, lid_locked)
+
+    def _fold(self, i, value):
+        if value < self.mins[i]:
+            self.mins[i] = value
+        if value > self.maxs[i]:
+            self.maxs[i] = value
+        self.sums[i] += value
+
+    def drain(self):
+        """The completed buckets, oldest first, as
+        [seconds ago, count, [min, max, mean] per channel], and forget
+        them."""
+        now = ticks_ms()
+        rv = []
+        for i in range(self.pending, 0, -1):
+            b = (self.head - i) % (self.size + 1)
+            base = b * len(CHANNELS)
+            count = self.counts[b]
+            rv.append([
+                ticks_diff(now, self.starts[b]) // 1000,
+                count,
+                [
+                    [self.mins[base + c], self.maxs[base + c],
+                     self.sums[base + c] // count]
+                    for c in range(len(CHANNELS))
+                ],
+            ])
+        self.pending = 0
+        return rv
+
+    def batch(self):
+        return {
+            "period": self.bucket_seconds,
+            "channels": CHANNELS,
+            "dropped": self.dropped,
+            "buckets": self.drain(),
+        }
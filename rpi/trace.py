@@ -0,0 +1,119 @@
+"""Compact binary traces of the raw washer ADC bursts.
+
+A trace file is a sequence of appendable records:
+
+    b'LT' <I ticks_ms> <H spacing_us> <H samples> <B channels>
+        then channels * samples uint16, one channel after another
+    b'LM' <I ticks_ms> <B event>
+        a marker, e.g. the moment the lid was seen to lock
+    b'LS'
+        a new session: the file was opened again, typically after a
+        reset, and ticks_ms started over
+
+Channels are in `Sampler` order: cycle_complete, blank, lid_locked.
+
+On the device, setting TRACE_PATH records every burst, and the marks
+come from State.annotate(), from the REPL or the Stats page, when the
+washer is seen to change. They are the only ground truth replay has.
+"""
+import struct
+from array import array
+
+from hal import ticks_diff
+
+CHUNK = '<2sIHHB'
+CHUNK_SIZE = struct.calcsize(CHUNK)
+MARK = '<2sIB'
+MARK_SIZE = struct.calcsize(MARK)
+SESSION = b'LS'
+
+EVENTS = ('lid_locked', 'cycle_complete', 'lid_unlocked')
+
+
+class TraceWriter:
+    # flush after this many records, to spare flash
+    flush_every = 32
+
+    def __init__(self, path):
+        self.fp = open(path, 'ab')
+        self.fp.write(SESSION)
+        self.pending = 0
+        self.header = bytearray(CHUNK_SIZE)
+
+    def write(self, now, spacing_us, *buffers):
+        struct.pack_into(
+            CHUNK, self.header, 0, b'LT', now, spacing_us, len(buffers[0]),
+            len(buffers)
+        )
+        self.fp.write(self.header)
+        for buf in buffers:
+            self.fp.write(buf)
+        self._written()
+
+    def mark(self, now, event):
+        self.fp.write(struct.pack(MARK, b'LM', now, EVENTS.index(event)))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.fp.flush()
+        self.pending = 0
+
+    def close(self):
+        self.fp.close()
+
+
+def read_trace(path):
+    """Yield ('chunk', ms, spacing_us, [array('H'), ...]) and
+    ('mark', ms, event), with ms counted from the first record so the
+    ticks_ms wraparound is undone. Ticks from different sessions can't be
+    compared, so each session carries on from where the last one ended.
+
+    This reads the whole file at once, so it is meant for the host.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    pos = 0
+    last = None
+    ms = 0
+    while pos + 2 <= len(data):
+        magic = data[pos:pos + 2]
+        if magic == SESSION:
+            pos += 2
+            last = None
+            continue
+        if magic == b'LT':
+            if pos + CHUNK_SIZE > len(data):
+                break
+            _, ticks, spacing_us, samples, channels = struct.unpack_from(
+                CHUNK, data, pos
+            )
+            pos += CHUNK_SIZE
+            size = 2 * samples
+            if pos + size * channels > len(data):
+                break
+            buffers = []
+            for i in range(channels):
+                buffers.append(array('H', data[pos:pos + size]))
+                pos += size
+        elif magic == b'LM':
+            if pos + MARK_SIZE > len(data):
+                break
+            _, ticks, event = struct.unpack_from(MARK, data, pos)
+            pos += MARK_SIZE
+        else:
+            raise ValueError(f'bad trace record at byte {pos}')
+
+        if last is None:
+            last = ticks
+        ms += ticks_diff(ticks, last)
+        last = ticks
+        if magic == b'LT':
+            yield ('chunk', ms, spacing_us, buffers)
+        else:
+            yield ('mark', ms, EVENTS[event])
@@ -1,16 +1,11 @@
-import gc
 from asyncio import sleep
 from array import array
-import bitmaptools
-import displayio
-import terminalio
-import vectorio
-import wifi
 
-from adafruit_display_shapes.roundrect import RoundRect
+from hal import (
+    gc, bitmaptools, displayio, terminalio, vectorio, wifi, RoundRect, Label,
+)
 #from adafruit_display_shapes.sparkline import Sparkline
-from adafruit_display_text.bitmap_label import Label
-
+from memstats import mem
 from display import display, backlight, touch_screen_point, back_button, beep
 
 
@@ -228,6 +223,7 @@ class PageStandard(Page):
         self.washer_status_elapsed_time = label(
             '10h 39m 20s', (80, 200), align=CENTER
         )
+        self.washer_status_eta = label('', (80, 216), align=CENTER)
 
         self.group.append(label('Dryer', (240, 40), scale=2, align=CENTER))
 
@@ -270,6 +266,15 @@ class PageStandard(Page):
                 self.group.append(self.washer_status_elapsed_time)
             self.washer_status_elapsed_time.text = elapsed
     
+    def set_washer_eta(self, remaining):
+        if not remaining:
+            if self.washer_status_eta in self.group:
+                self.group.remove(self.washer_status_eta)
+        else:
+            if self.washer_status_eta not in self.group:
+                self.group.append(self.washer_status_eta)
+            self.washer_status_eta.text = f'about {remaining} left'
+
     def set_dryer_state(self, state):
         if state != self.dryer_status.text:
             self.dryer_status.text = state
@@ -296,6 +301,7 @@ class PageAuto(PageStandard):
     def __init__(self, state):
         super().__init__('Auto')
         self.state = state
+        self.dryer_status_elapsed.text = 'Remaining:'
         self.confirm = None
         self.clear_confirm_zone = {
             (0, 30, 320, 240): self.clear_confirm,
@@ -315,6 +321,9 @@ class PageAuto(PageStandard):
     def update(self):
         self.set_washer_state(self.state.auto_state.washer_state)
         self.set_washer_elapsed(self.state.auto_state.washer_elapsed)
+        self.set_washer_eta(self.state.auto_state.washer_remaining)
+        self.set_dryer_state(self.state.auto_state.dryer_state)
+        self.set_dryer_elapsed(self.state.auto_state.dryer_remaining)
         self.alarm_group.hidden = self.state.alarm_state.state != 'Alarm'
         if not self.confirm and self.state.alarm_state.state == 'Alarm':
             self.touch_zones = self.clear_confirm_zone
@@ -326,7 +335,7 @@ class PageAuto(PageStandard):
             self.group.remove(self.confirm.group)
             self.touch_zones = {}
             self.confirm = None
-            gc.collect()
+            mem.collect()
             
     def clear_confirm(self):
         self.confirm = ConfirmBox('Are you sure you want to cancel the alarm?')
@@ -341,33 +350,64 @@ class PageStats(Page):
     def __init__(self, state):
         super().__init__('Stats')
         self.state = state
-        self.group.append(label('Mem Alloc:', (10, 100)))
-        self.group.append(label('Mem Free:', (10, 120)))
-        self.mem_alloc = label('', (100, 100))
-        self.mem_free = label('', (100, 120))
+        self.group.append(label('Mem Alloc:', (10, 40)))
+        self.group.append(label('Mem Free:', (10, 60)))
+        self.group.append(label('Low Water:', (10, 80)))
+        self.group.append(label('Free Block:', (10, 100)))
+        self.group.append(label('GC Runs:', (10, 120)))
+        self.group.append(label('Top Alloc:', (10, 140)))
+        self.mem_alloc = label('', (100, 40))
+        self.mem_free = label('', (100, 60))
+        self.mem_low = label('', (100, 80))
+        self.mem_block = label('', (100, 100))
+        self.mem_gcs = label('', (100, 120))
+        self.mem_top = label('', (100, 140))
         #self.mem_sparkline = Sparkline(
         #    width=160, height=40, max_items=64, y_min=0, y_max=65535,
         #    x=150, y=100
         #)
         self.group.append(self.mem_alloc)
         self.group.append(self.mem_free)
+        self.group.append(self.mem_low)
+        self.group.append(self.mem_block)
+        self.group.append(self.mem_gcs)
+        self.group.append(self.mem_top)
         #self.group.append(self.mem_sparkline)
 
-        self.group.append(label('Washer Sensors:', (10, 150)))
-        self.washer_sensors = label('', (100, 150))
+        self.group.append(label('Washer Sensors:', (10, 170)))
+        self.washer_sensors = label('', (100, 170))
         self.group.append(self.washer_sensors)
+
+        if state.recorder:
+            # while recording a trace, mark what is seen on the washer
+            self.group.append(label('Mark:', (10, 210)))
+            for i, (text, event) in enumerate((
+                    ('Locked', 'lid_locked'),
+                    ('Done', 'cycle_complete'),
+                    ('Unlocked', 'lid_unlocked'),
+            )):
+                self.group.append(label(text, (70 + 85 * i, 210)))
+                self.touch_zones[(60 + 85 * i, 195, 140 + 85 * i, 225)] = \
+                    (lambda event=event: state.annotate(event))
         
     def update(self):
         self.mem_alloc.text = str(gc.mem_alloc())
-        self.mem_free.text = str(self.state.max_free_mem)
+        self.mem_free.text = str(mem.free)
+        self.mem_low.text = str(mem.low_free)
+        self.mem_block.text = str(mem.largest_block)
+        self.mem_gcs.text = str(mem.collections)
+        top = mem.top_task
+        if top:
+            self.mem_top.text = f'{top} {mem.per_iteration(top)}/iter'
         #display.auto_refresh = False
         #self.mem_sparkline.add_value(gc.mem_free())
         #display.auto_refresh = True
+        snapshot = self.state.auto_state.sampler.snapshot
         self.washer_sensors.text = ' '.join(
-            f'{i.value}' for i in (
-                self.state.auto_state.washer.cycle_complete_raw,
-                self.state.auto_state.washer.blank_raw,
-                self.state.auto_state.washer.lid_locked_raw,
+            f'{i}' for i in (
+                snapshot.cycle_complete,
+                snapshot.blank,
+                snapshot.lid_locked,
             )
         )
 
@@ -400,7 +440,7 @@ class PageManual(PageStandard):
             self.group.remove(self.confirm.group)
             self.touch_zones = self.default_touch_zones
             self.confirm = None
-            gc.collect()
+            mem.collect()
         
     def touch_washer(self):
         if self.manual_state.washer_state == 'Idle':
@@ -447,14 +487,21 @@ class UI:
             backlight.value = True
             display.show(displayio.CIRCUITPYTHON_TERMINAL)
         else:
-            self._set_page(-1)
+            # after a reset, go straight to the restored state
+            self._set_page(self.mode_page if state.journal.restored else -1)
+
+    @property
+    def mode_page(self):
+        return 2 if self.state.mode == 'Manual' else 0
 
     def _set_page(self, index):
         self.page_index = index
         self.page = None
-        gc.collect()
+        mem.collect()
         if index == -1:
-            self.page = PageBoot(self.cloud, (lambda: self._set_page(0)))
+            self.page = PageBoot(
+                self.cloud, (lambda: self._set_page(self.mode_page))
+            )
         elif index == 0:
             self.page = PageAuto(self.state)
             self.state.set_mode('Auto')
@@ -464,7 +511,7 @@ class UI:
             self.page = PageManual(self.state.manual_state)
             self.state.set_mode('Manual')
         display.show(self.page.group)
-        gc.collect()
+        mem.collect()
 
     async def run(self):
         if self.console:
@@ -474,6 +521,7 @@ class UI:
         touched = False
         back_button_released = back_button.value
         while True:
+            start = mem.begin()
             backlight.value = self.state.awake
             self.page.wifi.set_status(wifi.radio.connected)
             self.page.iot.set_status(self.cloud.connected)
@@ -499,7 +547,7 @@ class UI:
                         touched = self.page.touch(touch)
                 except MemoryError:
                     beep(100)
-                    gc.collect()
+                    mem.collect()
                     
             else:
                 touched = False
@@ -511,10 +559,12 @@ class UI:
                     
                     await sleep(0.15)
                     
-                    import microcontroller
+                    from hal import microcontroller
 
+                    self.state.journal.save(force=True)
                     microcontroller.reset()
             else:
                 back_button_released = True
 
+            mem.end('ui', start)
             await sleep(0.15)
@@ -1,6 +1,12 @@
-import struct
 import ssl
-from errno import EAGAIN
+from errno import EAGAIN, EINPROGRESS, EALREADY
+try:
+    from errno import EISCONN
+except ImportError:
+    EISCONN = 127  # lwIP
+from asyncio import sleep, create_task, wait_for, Lock
+from hal import ticks_ms, ticks_add, ticks_diff
+import jsonstream
 # from binascii import hexlify
 
 
@@ -9,6 +15,9 @@ class MQTTException(Exception):
 
 
 class MQTTClient:
+    # initial receive buffer; grows to fit the largest frame seen
+    rx_size = 256
+
     def __init__(
         self,
         client_id,
@@ -41,20 +50,66 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # outgoing packets are framed here and sent with one call, so
+        # each becomes a single TLS record; grows on demand. What is to
+        # be sent is _buf[_start:_len]
+        self._buf = bytearray(128)
+        self._start = 0
+        self._len = 0
+        # where the last PUBLISH was framed, and its payload size
+        self._pkt_at = 0
+        self.payload_size = 0
+        # incoming bytes land in _rx and are parsed in place between
+        # _rhead and _rtail; a frame's body is _rx[_body:_rhead]
+        self._rx = bytearray(self.rx_size)
+        self._rxv = memoryview(self._rx)
+        self._rhead = 0
+        self._rtail = 0
+        self._body = 0
+        self._free = None
+        self._free_at = -1
 
-    def _send_str(self, s):
-        self.sock.send(struct.pack("!H", len(s)))
-        self.sock.send(s)
+    def _reserve(self, n):
+        need = self._len + n
+        if need > len(self._buf):
+            buf = bytearray(max(need, 2 * len(self._buf)))
+            buf[:self._len] = memoryview(self._buf)[:self._len]
+            self._buf = buf
 
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self._sock_exact_recv(1)[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
+    def _byte(self, b):
+        self._reserve(1)
+        self._buf[self._len] = b
+        self._len += 1
+
+    def _u16(self, v):
+        self._reserve(2)
+        self._buf[self._len] = v >> 8
+        self._buf[self._len + 1] = v & 0xFF
+        self._len += 2
+
+    def _varint(self, sz):
+        while sz > 0x7F:
+            self._byte((sz & 0x7F) | 0x80)
+            sz >>= 7
+        self._byte(sz)
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        n = len(data)
+        self._reserve(n)
+        self._buf[self._len:self._len + n] = data
+        self._len += n
+
+    def _flush(self):
+        sent = self._start
+        while sent < self._len:
+            sent += self.sock.send(memoryview(self._buf)[sent:self._len])
+        self._start = self._len = 0
+
+    def _send_str(self, s):
+        self._u16(len(s))
+        self._write(s)
 
     def set_callback(self, f):
         self.cb = f
@@ -67,60 +122,119 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def _sock_exact_recv(self, bufsize, block=True):
-        rc = bytearray(bufsize)
-        mv = memoryview(rc)
-        try:
-            recv_len = self.sock.recv_into(rc, bufsize)
-        except OSError as error:
-            if error.errno == EAGAIN and not block:
+    def _fill(self):
+        # receive more bytes behind _rtail, making room first; raises
+        # EAGAIN from a non-blocking socket with nothing to read
+        if self._rhead == self._rtail:
+            self._rhead = self._rtail = 0
+        elif self._rtail == len(self._rx):
+            self._compact()
+        if self._free_at != self._rtail:
+            self._free = self._rxv[self._rtail:]
+            self._free_at = self._rtail
+        n = self.sock.recv_into(self._free, len(self._free))
+        if n == 0:
+            raise OSError(-1)
+        self._rtail += n
+
+    def _compact(self):
+        # move the partial frame at _rhead to the front, or grow the
+        # buffer if that frame fills it
+        rx = self._rx
+        n = self._rtail - self._rhead
+        if self._rhead == 0:
+            rx = bytearray(2 * len(rx))
+            rx[:n] = self._rx
+            self._rx = rx
+            self._rxv = memoryview(rx)
+        else:
+            head = self._rhead
+            for i in range(n):
+                rx[i] = rx[head + i]
+        self._rhead = 0
+        self._rtail = n
+        self._free_at = -1
+
+    def _frame(self):
+        # -> header byte of the next whole frame buffered, or None
+        rx = self._rx
+        i = self._rhead + 1
+        n = 0
+        sh = 0
+        while 1:
+            if i >= self._rtail:
                 return None
-            raise
-        to_read = bufsize - recv_len
-        if to_read < 0:
-            raise Exception(f'negative bytes to read: {to_read}')
-        mv = mv[recv_len:]
-        while to_read > 0:
-            recv_len = self.sock.recv_into(mv, to_read)
-            to_read -= recv_len
-            mv = mv[recv_len:]
-        return rc
-        
-    def connect(self, clean_session=True):
+            b = rx[i]
+            i += 1
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        if i + n > self._rtail:
+            return None
+        op = rx[self._rhead]
+        self._body = i
+        self._rhead = i + n
+        return op
+
+    def _frame_u16(self, offset):
+        i = self._body + offset
+        return self._rx[i] << 8 | self._rx[i + 1]
+
+    def _deliver(self, op):
+        # hand a PUBLISH frame to the callback as memoryviews into the
+        # receive buffer, valid until the callback returns; -> whether
+        # a PUBACK was framed and needs flushing
+        i = self._body
+        topic_len = self._frame_u16(0)
+        topic = self._rxv[i + 2:i + 2 + topic_len]
+        i += 2 + topic_len
+        pid = 0
+        if op & 6:
+            pid = self._rx[i] << 8 | self._rx[i + 1]
+            i += 2
+        self.cb(topic, self._rxv[i:self._rhead])
+        if op & 6 == 2:
+            self._write(b"\x40\x02")
+            self._u16(pid)
+            return True
+        elif op & 6 == 4:
+            assert 0
+        return False
+
+    def _open(self):
         addr = self.socket_pool.getaddrinfo(self.server, self.port)[0]
         self.sock = self.socket_pool.socket(addr[0], addr[1])
         if self.ssl:
             self.sock = self.ssl_context.wrap_socket(
                 self.sock, server_hostname=self.server
             )
+
+    def connect(self, clean_session=True):
+        self._open()
         self.sock.connect((self.server, self.port))
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        self._send_connect(clean_session)
+        self._flush()
+        return self._connack(self.wait_msg())
 
+    def _send_connect(self, clean_session):
         sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+        flags = clean_session << 1
         if self.user is not None:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
-        if self.keepalive:
-            assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
+            flags |= 0xC0
+        assert self.keepalive < 65536
         if self.lw_topic:
             sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
 
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-
-        self.sock.send(premsg[:i + 2])
-        self.sock.send(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
+        self._byte(0x10)
+        self._varint(sz)
+        self._send_str(b"MQTT")
+        self._byte(4)
+        self._byte(flags)
+        self._u16(self.keepalive)
         self._send_str(self.client_id)
         if self.lw_topic:
             self._send_str(self.lw_topic)
@@ -128,112 +242,434 @@ class MQTTClient:
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self._sock_exact_recv(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+
+    def _connack(self, op):
+        assert op == 0x20 and self._rhead - self._body == 2
+        rc = self._rx[self._body + 1]
+        if rc != 0:
+            raise MQTTException(rc)
+        return self._rx[self._body] & 1
 
     def disconnect(self):
-        self.sock.send(b"\xe0\0")
+        self._write(b"\xe0\0")
+        self._flush()
         self.sock.close()
 
     def ping(self):
-        self.sock.send(b"\xc0\0")
+        self._write(b"\xc0\0")
+        self._flush()
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        pid = self._send_publish(topic, msg, retain, qos)
+        self._flush()
+        if qos == 1:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40 and self._frame_u16(0) == pid:
+                    return
+        elif qos == 2:
+            assert 0
+
+    def _send_publish(self, topic, msg, retain, qos):
+        if isinstance(msg, (dict, list)):
+            return self._send_publish_json(topic, msg, retain, qos)
+        self._pkt_at = self._len
+        self.payload_size = len(msg)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.send(pkt[:i + 1])
+        self._byte(0x30 | qos << 1 | retain)
+        self._varint(sz)
         self._send_str(topic)
+        pid = None
         if qos > 0:
-            self.pid += 1
+            self.pid = self.pid % 0xFFFF + 1
             pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.send(pkt[:2])
-        self.sock.send(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self._sock_exact_recv(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self._sock_exact_recv(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            self._u16(pid)
+        self._write(msg)
+        return pid
 
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.send(pkt)
+    def _send_publish_json(self, topic, obj, retain, qos):
+        # the payload is encoded straight into the buffer; the fixed
+        # header goes in front once its length is known, in room left
+        # for the longest remaining length
+        head = self._len
+        self._reserve(5)
+        self._len += 5
+        body = self._len
         self._send_str(topic)
-        self.sock.send(qos.to_bytes(1, "little"))
+        pid = None
+        if qos > 0:
+            self.pid = self.pid % 0xFFFF + 1
+            pid = self.pid
+            self._u16(pid)
+        payload = self._len
+        jsonstream.dump(obj, self._write)
+        self.payload_size = self._len - payload
+        sz = self._len - body
+        assert sz < 268435456
+        n = 1
+        while sz >> 7 * n:
+            n += 1
+        start = body - 1 - n
+        buf = self._buf
+        buf[start] = 0x30 | qos << 1 | retain
+        for i in range(n):
+            b = (sz >> 7 * i) & 0x7F
+            buf[start + 1 + i] = b | 0x80 if i < n - 1 else b
+        gap = start - head
+        if head == self._start:
+            # nothing queued in front: start sending past the slack
+            self._start = start
+            self._pkt_at = start
+        else:
+            # close the slack behind what is already queued
+            for i in range(start, self._len):
+                buf[i - gap] = buf[i]
+            self._len -= gap
+            self._pkt_at = head
+        return pid
+
+    def subscribe(self, topic, qos=0):
+        pid = self._send_subscribe(topic, qos)
+        self._flush()
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self._sock_exact_recv(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                assert self._frame_u16(0) == pid
+                if self._rx[self._body + 2] == 0x80:
+                    raise MQTTException(0x80)
                 return
 
+    def _send_subscribe(self, topic, qos):
+        assert self.cb is not None, "Subscribe callback is not set"
+        self.pid = self.pid % 0xFFFF + 1
+        self._byte(0x82)
+        self._varint(2 + 2 + len(topic) + 1)
+        self._u16(self.pid)
+        self._send_str(topic)
+        self._byte(qos)
+        return self.pid
+
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
+    # messages processed internally. Frames may arrive in pieces;
+    # whatever has arrived stays buffered for the next call.
     def wait_msg(self, block=True):
-        res = self._sock_exact_recv(1, block)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self._sock_exact_recv(1)[0]
-            assert sz == 0
+        op = self._frame()
+        while op is None:
+            try:
+                self._fill()
+            except OSError as error:
+                if error.errno == EAGAIN and not block:
+                    return None
+                raise
+            op = self._frame()
+        if op == 0xD0:  # PINGRESP
             return None
-        op = res[0]
         if op & 0xF0 != 0x30:
             return op
-        sz = self._recv_len()
-        topic_len = self._sock_exact_recv(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self._sock_exact_recv(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self._sock_exact_recv(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self._sock_exact_recv(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.send(pkt)
-        elif op & 6 == 4:
-            assert 0
+        if self._deliver(op):
+            self._flush()
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
         self.sock.setblocking(False)
-        return self.wait_msg(block=False)
+        try:
+            return self.wait_msg(block=False)
+        finally:
+            self.sock.setblocking(True)
+
+
+class AsyncMQTTClient(MQTTClient):
+    """MQTTClient for asyncio: the socket is non-blocking, packets are
+    framed by the MQTTClient methods and drained without blocking, and
+    a background task reads and dispatches whatever
+    the broker sends. Awaiting connect/subscribe/publish only ever
+    suspends the caller, never the event loop (DNS lookup aside).
+
+    Sending gives up with MQTTException if the socket stays full for
+    `timeout`, or with the reader's error if it has failed.
+
+    QoS 1 publishes are pipelined: publish() returns once the packet is
+    sent, a copy stays in an in-flight table keyed by pid until its
+    PUBACK comes through the reader, and is resent with DUP set every
+    `retry_ms` until then. Acknowledged entries and their buffers are
+    kept for the next publishes, so copies only allocate while they grow
+    to fit. Only `window` may be in flight at once. A
+    publish still unacknowledged after `retries` resends fails the link
+    with MQTTException, as does waiting on a full window that long.
+
+    With a keepalive set, the reader sends PINGREQ once nothing has been
+    sent or received for half of it, and fails with MQTTException if
+    nothing at all comes back within `ping_timeout_ms`: the socket is
+    half-open."""
+    # seconds between socket polls while a reply is due; while none is,
+    # the reader backs off to `idle_poll`, or a quarter of the keepalive,
+    # so an unprompted message or a first PUBACK may wait that long
+    poll = 0.05
+    idle_poll = 4.0
+    # seconds to wait on the broker for a CONNACK or SUBACK, or for
+    # room in a full socket
+    timeout = 10.0
+    # unacknowledged QoS 1 publishes allowed at once
+    window = 4
+    # milliseconds before an unacknowledged publish is resent
+    retry_ms = 10000
+    # resends of an unacknowledged publish before giving up on the link
+    retries = 3
+    # milliseconds to wait for any reply to a PINGREQ
+    ping_timeout_ms = 5000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = None
+        self._reader = None
+        self._acks = {}
+        # pid -> [resend deadline, packet buffer, resends, packet size]
+        self._inflight = {}
+        # acknowledged entries, for reuse
+        self._spare = []
+        self.retransmits = 0
+        # when anything was last sent, and last received
+        self._tx_at = 0
+        self._rx_at = 0
+        self._ping_at = None
+        # callers waiting on a SUBACK
+        self._waiting = 0
+        # whether the CONNACK is in; until it is, nothing is resent
+        self._up = False
+        self.error = None
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    async def _drain(self):
+        # packets framed by other tasks while this waits on a full
+        # socket go out in the same pass. A socket that stays full for
+        # `timeout` is a dead link; give up rather than hold the lock
+        async with self._lock:
+            sent = self._start
+            deadline = ticks_add(ticks_ms(), int(self.timeout * 1000))
+            while sent < self._len:
+                try:
+                    n = self.sock.send(memoryview(self._buf)[sent:self._len])
+                except OSError as error:
+                    if error.errno != EAGAIN:
+                        raise
+                    n = 0
+                if n:
+                    sent += n
+                    continue
+                self.check()
+                if ticks_diff(ticks_ms(), deadline) >= 0:
+                    raise MQTTException('timed out sending')
+                await sleep(self.poll)
+            self._start = self._len = 0
+            self._tx_at = ticks_ms()
+
+    async def _next(self):
+        # -> header byte of the next whole frame, polling the socket
+        idle = self.idle_poll
+        if self.keepalive:
+            idle = min(idle, self.keepalive / 4)
+        delay = self.poll
+        op = self._frame()
+        while op is None:
+            try:
+                self._fill()
+            except OSError as error:
+                if error.errno != EAGAIN:
+                    raise
+                # the reader polls anyway, so it also times the resends
+                # and keepalive pings, once the session is up
+                if self._up:
+                    now = ticks_ms()
+                    if self._inflight:
+                        await self._resend(now)
+                    if self.keepalive:
+                        await self._keepalive(now)
+                await sleep(delay)
+                if not self._up or self._inflight or self._waiting \
+                        or self._ping_at is not None:
+                    delay = self.poll
+                else:
+                    delay = min(delay * 2, idle)
+            op = self._frame()
+        # anything from the broker shows the link is alive
+        self._rx_at = ticks_ms()
+        self._ping_at = None
+        return op
+
+    async def _keepalive(self, now):
+        if self._ping_at is not None:
+            if ticks_diff(now, self._ping_at) > self.ping_timeout_ms:
+                raise MQTTException('no reply to PINGREQ')
+        elif max(ticks_diff(now, self._tx_at),
+                 ticks_diff(now, self._rx_at)) >= self.keepalive * 500:
+            self._ping_at = now
+            await self.ping()
+
+    async def _sock_connect(self):
+        # a broker that never answers is given up on after `timeout`,
+        # rather than whenever the network stack would
+        self.sock.setblocking(False)
+        deadline = ticks_add(ticks_ms(), int(self.timeout * 1000))
+        while True:
+            try:
+                self.sock.connect((self.server, self.port))
+                return
+            except OSError as error:
+                if error.errno == EISCONN:
+                    return
+                if error.errno not in (EINPROGRESS, EALREADY, EAGAIN):
+                    raise
+            if ticks_diff(ticks_ms(), deadline) >= 0:
+                raise MQTTException('timed out connecting')
+            await sleep(self.poll)
+
+    async def connect(self, clean_session=True):
+        self._lock = Lock()
+        self._start = self._len = 0
+        self._rhead = self._rtail = 0
+        self._ping_at = None
+        self._acks = {}
+        self._up = False
+        self.error = None
+        self._open()
+        await sleep(0)
+        await self._sock_connect()
+        self._send_connect(clean_session)
+        await self._drain()
+        present = self._connack(await wait_for(self._next(), self.timeout))
+        # whatever was in flight on the last connection goes out again,
+        # with its resends counted afresh
+        now = ticks_ms()
+        for entry in self._inflight.values():
+            entry[0] = now
+            entry[2] = 0
+        self._up = True
+        self._reader = create_task(self._read_loop())
+        return present
+
+    async def _wait_ack(self, key):
+        waited = 0.0
+        self._waiting += 1
+        try:
+            while key not in self._acks:
+                self.check()
+                if waited > self.timeout:
+                    raise MQTTException('timed out waiting for ack')
+                await sleep(self.poll)
+                waited += self.poll
+        finally:
+            self._waiting -= 1
+        return self._acks.pop(key)
+
+    async def subscribe(self, topic, qos=0):
+        self._send_subscribe(topic, qos)
+        pid = self.pid
+        await self._drain()
+        if await self._wait_ack((0x90, pid)) == 0x80:
+            raise MQTTException(0x80)
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2, "QoS 2 is not supported"
+        if qos == 0:
+            self._send_publish(topic, msg, retain, qos)
+            await self._drain()
+            return None
+        # the reader resends and fails the link, but if it cannot, stop
+        # waiting once the oldest publish is that far past its resends
+        overdue = self.retry_ms * (self.retries + 1)
+        while len(self._inflight) >= self.window:
+            self.check()
+            now = ticks_ms()
+            for entry in self._inflight.values():
+                if ticks_diff(now, entry[0]) > overdue:
+                    raise MQTTException('publish window stuck')
+            await sleep(self.poll)
+        pid = self._send_publish(topic, msg, retain, qos)
+        self._inflight[pid] = self._keep(self._pkt_at, self._len)
+        await self._drain()
+        return pid
+
+    def _keep(self, start, end):
+        # -> an in-flight entry holding a copy of _buf[start:end]
+        n = end - start
+        if self._spare:
+            entry = self._spare.pop()
+        else:
+            entry = [0, bytearray(0), 0, 0]
+        if len(entry[1]) < n:
+            entry[1] = bytearray(max(n, 2 * len(entry[1])))
+        entry[1][:n] = memoryview(self._buf)[start:end]
+        entry[0] = ticks_add(ticks_ms(), self.retry_ms)
+        entry[2] = 0
+        entry[3] = n
+        return entry
+
+    def _acked(self, pid):
+        entry = self._inflight.pop(pid, None)
+        if entry is not None:
+            self._spare.append(entry)
+
+    async def _resend(self, now):
+        due = False
+        for entry in self._inflight.values():
+            if ticks_diff(now, entry[0]) >= 0:
+                if entry[2] >= self.retries:
+                    raise MQTTException('no PUBACK')
+                entry[2] += 1
+                pkt = entry[1]
+                pkt[0] |= 0x08  # DUP
+                self._write(memoryview(pkt)[:entry[3]])
+                entry[0] = ticks_add(now, self.retry_ms)
+                self.retransmits += 1
+                due = True
+        if due:
+            await self._drain()
+
+    async def ping(self):
+        self._write(b"\xc0\0")
+        await self._drain()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                await self._dispatch(await self._next())
+        except Exception as error:
+            self.error = error
+
+    async def _dispatch(self, op):
+        kind = op & 0xF0
+        if kind == 0x30:
+            if self._deliver(op):
+                await self._drain()
+        elif kind == 0x40:
+            self._acked(self._frame_u16(0))
+        elif kind == 0x90:
+            self._acks[(kind, self._frame_u16(0))] = \
+                self._rx[self._body + 2]
+
+    def check(self):
+        """Raise whatever stopped the reader task."""
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self.sock is not None:
+            try:
+                self.sock.send(b"\xe0\0")
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None